@@ -3,29 +3,102 @@
 # File: main.py
 
 import argparse
-import math
+import json
 import shutil
+import subprocess
+import time
 import urllib.parse
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Literal
+from typing import List, Literal, Optional
 
+import numpy as np
 import uvicorn
-from fastapi import Depends, FastAPI, UploadFile
+from fastapi import Depends, FastAPI, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from midi2audio import FluidSynth
-from musgen.gansynth import synth
+from musgen.gansynth import synth, synth_stream
 from musgen.magenta_rnn import MagentaRNN
 from musgen.types_ import NoteDicts
-from musgen.utils import notes2noteseq, noteseq2notes
+from musgen.utils import (NOTES_MEDIA_TYPE, PCM_STREAM_MEDIA_TYPE, WAV_MEDIA_TYPE, accepts_notes_array,
+                          accepts_pcm_stream, accepts_wav, array2notes, decode_notes, encode_notes, notes2noteseq,
+                          noteseq2array, trim_context, wav_bytes)
 from pydantic import BaseModel
 from scipy.io import wavfile
 
 
 class MagentaRNNArgs(BaseModel):
-    notes: NoteDicts
     qpm: int
     extend_duration: int
     temperature: float = 1.0
+    context_seconds: Optional[float] = None  # only prime the model with the last seconds of the notes
+
+
+async def request_notes(request: Request) -> NoteDicts:
+    """Notes in the request body, as JSON `NoteDicts` or as a `NOTES_MEDIA_TYPE` array."""
+
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith(NOTES_MEDIA_TYPE):
+        return array2notes(decode_notes(body))
+    return json.loads(body)
+
+
+def notes_response(notes: np.ndarray, request: Request):
+    """Return a `NOTE_DTYPE` array as a `NOTES_MEDIA_TYPE` array if the client accepts it, else as JSON."""
+
+    if accepts_notes_array(request.headers.get("accept")):
+        return Response(content=encode_notes(notes), media_type=NOTES_MEDIA_TYPE)
+    return array2notes(notes)
+
+
+def wav_response(audio: np.ndarray, sample_rate: int) -> Response:
+    """Audio as a WAV file, with its sample rate and dtype also in the headers."""
+
+    return Response(
+        content=wav_bytes(audio, sample_rate),
+        media_type=WAV_MEDIA_TYPE,
+        headers={"X-Sample-Rate": str(sample_rate), "X-Dtype": audio.dtype.str},
+    )
+
+
+def pcm_stream_response(blocks, sample_rate: int, dtype: str, channels: int) -> StreamingResponse:
+    """Raw interleaved PCM sent with chunked transfer as `blocks` (bytes) are produced."""
+
+    return StreamingResponse(
+        blocks,
+        media_type=PCM_STREAM_MEDIA_TYPE,
+        headers={"X-Sample-Rate": str(sample_rate), "X-Dtype": dtype, "X-Channels": str(channels)},
+    )
+
+
+def fluidsynth_stream(midi_path: Path, raw_path: Path, sample_rate: int, sound_font: str, chunk_size: int = 1 << 16):
+    """
+    Render a MIDI file with the FluidSynth CLI to raw 16-bit stereo PCM, yielding it while FluidSynth writes it.
+    """
+
+    process = subprocess.Popen(
+        ["fluidsynth", "-ni", "-F", str(raw_path), "-T", "raw", "-O", "s16", "-E", "little", "-r", str(sample_rate),
+         sound_font, str(midi_path)],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        while not raw_path.exists():
+            if process.poll() is not None:
+                return
+            time.sleep(0.01)
+        with open(raw_path, "rb") as f:
+            while True:
+                running = process.poll() is None
+                data = f.read(chunk_size)
+                if data:
+                    yield data
+                elif not running:
+                    break
+                else:
+                    time.sleep(0.02)
+    finally:
+        if process.poll() is None:
+            process.kill()
 
 
 @asynccontextmanager
@@ -47,62 +120,102 @@ async def main():
 @app.post("/melody_rnn/{model}")
 def melody_rnn(
     model: Literal["basic_rnn", "mono_rnn", "lookback_rnn", "attention_rnn"],
+    request: Request,
     args: MagentaRNNArgs = Depends(),
+    notes: NoteDicts = Depends(request_notes),
 ) -> NoteDicts:
     print(f"Extending notes using {model} from Melody RNN")
-    last_end_time = max([note["start_time"] + note["duration"] for note in args.notes])
+    notes, offset = trim_context(notes, args.qpm, args.context_seconds)
+    last_end_time = max([note["start_time"] + note["duration"] for note in notes])
     generator = MagentaRNN.MelodyRNN(model)
-    seq = generator(notes2noteseq(args.notes, args.qpm), args.extend_duration, args.temperature)
-    return [note for note in noteseq2notes(seq) if note["start_time"] >= last_end_time]
+    seq = generator(notes2noteseq(notes, args.qpm), args.extend_duration, args.temperature)
+    generated = noteseq2array(seq)
+    generated = generated[generated["start_time"] >= last_end_time]
+    generated["start_time"] += offset
+    return notes_response(generated, request)
 
 
 @app.post("/performance_rnn/{model}")
 def performance_rnn(
     model: Literal["performance", "performance_with_dynamics", "performance_with_dynamics_and_modulo_encoding", "density_conditioned_performance_with_dynamics", "pitch_conditioned_performance_with_dynamics", "multiconditioned_performance_with_dynamics"],
+    request: Request,
     args: MagentaRNNArgs = Depends(),
+    notes: NoteDicts = Depends(request_notes),
 ) -> NoteDicts:
     print(f"Extending notes using {model} from Performance RNN")
+    notes, offset = trim_context(notes, args.qpm, args.context_seconds)
     generator = MagentaRNN.PerformanceRNN(model)
-    seq = generator(notes2noteseq(args.notes, args.qpm), args.extend_duration, args.temperature)
-    return noteseq2notes(seq)[len(args.notes):]
+    seq = generator(notes2noteseq(notes, args.qpm), args.extend_duration, args.temperature)
+    generated = noteseq2array(seq)[len(notes):]
+    generated["start_time"] += offset
+    return notes_response(generated, request)
 
 
 @app.post("/gansynth")
 async def gansynth(
     midi_file: UploadFile,
+    request: Request,
     seconds_per_instrument: float = 5,
     sample_rate: int = 16000,
 ) -> List[float]:
     midi_path: Path = Path("tmp") / urllib.parse.quote(midi_file.filename)
     print(f"Synthesizing audio from MIDI {midi_path}")
+    streaming = False
     try:
         with open(midi_path, "wb") as f:
             f.write(await midi_file.read())
-        audio = synth(midi_path, seconds_per_instrument, sample_rate).tolist()
-        audio = [value for value in audio if not (math.isnan(value) or math.isinf(value))]
-        return audio
+        if accepts_pcm_stream(request.headers.get("accept")):
+            def blocks():
+                try:
+                    for block in synth_stream(midi_path, seconds_per_instrument, sample_rate):
+                        yield block.tobytes()
+                finally:
+                    midi_path.unlink(missing_ok=True)
+
+            streaming = True
+            return pcm_stream_response(blocks(), sample_rate, "<f4", 1)
+        audio = synth(midi_path, seconds_per_instrument, sample_rate)
+        audio = audio[np.isfinite(audio)].astype(np.float32)
+        if accepts_wav(request.headers.get("accept")):
+            return wav_response(audio, sample_rate)
+        return audio.tolist()
     finally:
-        if midi_path.exists():
+        if not streaming and midi_path.exists():
             midi_path.unlink()
 
 
 @app.post("/midi2wav")
-async def midi2wav(midi_file: UploadFile):
+async def midi2wav(midi_file: UploadFile, request: Request):
     midi_path: Path = Path("tmp") / urllib.parse.quote(midi_file.filename)
     wav_path = Path(f"{midi_path}.wav")
+    streaming = False
     try:
         with open(midi_path, "wb") as f:
             f.write(await midi_file.read())
         fs = FluidSynth()
+        if accepts_pcm_stream(request.headers.get("accept")):
+            raw_path = Path(f"{midi_path}.raw")
+
+            def blocks():
+                try:
+                    yield from fluidsynth_stream(midi_path, raw_path, fs.sample_rate, fs.sound_font)
+                finally:
+                    midi_path.unlink(missing_ok=True)
+                    raw_path.unlink(missing_ok=True)
+
+            streaming = True
+            return pcm_stream_response(blocks(), fs.sample_rate, "<i2", 2)
         fs.midi_to_audio(midi_path, wav_path)
         sr, audio = wavfile.read(wav_path)
+        if accepts_wav(request.headers.get("accept")):
+            return wav_response(audio, sr)
         return {
             "sample_rate": sr,
             "audio": audio.tolist(),
             "dtype": audio.dtype.str,
         }
     finally:
-        if midi_path.exists():
+        if not streaming and midi_path.exists():
             midi_path.unlink()
         if wav_path.exists():
             wav_path.unlink()
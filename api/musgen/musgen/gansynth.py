@@ -113,7 +113,7 @@ def combine_notes(audio_notes, start_times, end_times, velocities, sr=16000):
     return audio_clip
 
 
-def synth(midi_path: str, seconds_per_instrument: float = 5, sr: int = 16000):
+def load_model():
     global model
     if model is None:
         if os.path.exists(model_directory_path):
@@ -122,6 +122,11 @@ def synth(midi_path: str, seconds_per_instrument: float = 5, sr: int = 16000):
         else:
             print("GANSynth model is not in local")
             model = lib_model.Model.load_from_path(CKPT_DIR, flags)
+    return model
+
+
+def synth(midi_path: str, seconds_per_instrument: float = 5, sr: int = 16000):
+    model = load_model()
 
     ns, notes = load_midi(midi_path)
 
@@ -144,3 +149,68 @@ def synth(midi_path: str, seconds_per_instrument: float = 5, sr: int = 16000):
         sr=sr,
     )
     return audio_clip
+
+
+def peak_bound(start_times, end_times, velocities, t_release=0.3):
+    """
+    Upper bound of the absolute peak of a clip made like `combine_notes`, before its final normalization, if every
+    note is normalized to an absolute peak of vel / 127: the largest sum of the velocities of the notes sounding at
+    the same time.
+    """
+    note_ends = start_times + np.minimum(end_times - start_times, 3.0) + t_release
+    times = np.concatenate([start_times, note_ends])
+    changes = np.concatenate([velocities / 127.0, -velocities / 127.0])
+    order = np.lexsort((changes, times))  # ends before starts at the same time
+    return max(np.cumsum(changes[order]).max(), 1e-6)
+
+
+def synth_stream(midi_path: str, seconds_per_instrument: float = 5, sr: int = 16000, segment_seconds: float = 4.0):
+    """
+    Like `synth`, but yields the audio segment by segment as soon as it is final, instead of all at once.
+
+    Notes are generated in batches of `segment_seconds` of start times. Once the notes starting before the end of a
+    segment have been generated, no later note can change the audio before that point, so it is yielded. Since the
+    peak of the whole clip is not known until the end, notes are normalized by their absolute peak and the clip is
+    scaled by `peak_bound` instead of normalized, so no sample exceeds 0.5 in either direction.
+
+    Yields:
+        np.ndarray: Consecutive float32 blocks of the audio clip
+    """
+    model = load_model()
+
+    ns, notes = load_midi(midi_path)
+    order = np.argsort(notes["start_times"], kind="stable")
+    start_times = notes["start_times"][order]
+    end_times = notes["end_times"][order]
+    velocities = notes["velocities"][order]
+    pitches = notes["pitches"][order]
+
+    z_instruments, t_instruments = gu.get_random_instruments(
+        model, notes["end_times"][-1], secs_per_instrument=seconds_per_instrument)
+    z_notes = gu.get_z_notes(start_times, z_instruments, t_instruments)
+
+    gain = 0.5 / peak_bound(start_times, end_times, velocities)
+    clip_length = end_times.max() + 3.0
+    audio_clip = np.zeros(int(clip_length) * sr)
+    emitted = 0
+    segment_end = 0.0
+    first = 0
+    while first < len(start_times):
+        segment_end += segment_seconds
+        last = int(np.searchsorted(start_times, segment_end, side="left"))
+        if last > first:
+            audio_notes = model.generate_samples_from_z(z_notes[first:last], pitches[first:last])
+            for i in range(last - first):
+                t_start, t_end, vel = start_times[first + i], end_times[first + i], velocities[first + i]
+                envelope = get_envelope(t_end - t_start, sr=sr)
+                length = len(envelope)
+                audio_note = audio_notes[i, :length] * envelope
+                audio_note /= np.abs(audio_note).max()
+                audio_note *= (vel / 127.0)
+                clip_start = int(t_start * sr)
+                audio_clip[clip_start:clip_start + length] += audio_note[:len(audio_clip) - clip_start]
+            first = last
+        final = min(int(segment_end * sr), len(audio_clip)) if first < len(start_times) else len(audio_clip)
+        if final > emitted:
+            yield np.nan_to_num(audio_clip[emitted:final] * gain).astype(np.float32)
+            emitted = final
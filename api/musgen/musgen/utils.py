@@ -2,8 +2,13 @@
 # File: utils.py
 
 import copy
+import io
+import math
+from typing import Optional, Tuple
 
 import note_seq
+import numpy as np
+from scipy.io import wavfile
 from note_seq.protobuf import music_pb2
 from note_seq.protobuf.music_pb2 import NoteSequence
 
@@ -38,6 +43,101 @@ def noteseq2notes(seq: NoteSequence) -> NoteDicts:
     ]
 
 
+NOTES_MEDIA_TYPE = "application/x-npy"
+NOTE_DTYPE = np.dtype([("note", "<i2"), ("start_time", "<f8"), ("duration", "<f8"), ("velocity", "<i2")])
+"""
+Columnar alternative to `NoteDicts`: a NumPy structured array with one typed field per key, sent as a `.npy` file
+with the `NOTES_MEDIA_TYPE` content type.
+"""
+
+
+def notes2array(notes: NoteDicts) -> np.ndarray:
+    array = np.empty(len(notes), dtype=NOTE_DTYPE)
+    for name in NOTE_DTYPE.names:
+        array[name] = [note[name] for note in notes]
+    return array
+
+
+def array2notes(array: np.ndarray) -> NoteDicts:
+    columns = [array[name].tolist() for name in NOTE_DTYPE.names]
+    return [dict(zip(NOTE_DTYPE.names, values)) for values in zip(*columns)]
+
+
+def noteseq2array(seq: NoteSequence) -> np.ndarray:
+    array = np.empty(len(seq.notes), dtype=NOTE_DTYPE)
+    array["note"] = [note.pitch for note in seq.notes]
+    start_time = np.array([note.start_time for note in seq.notes], dtype=np.float64)
+    array["start_time"] = start_time
+    array["duration"] = np.array([note.end_time for note in seq.notes], dtype=np.float64) - start_time
+    array["velocity"] = [note.velocity for note in seq.notes]
+    return array
+
+
+def encode_notes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array.astype(NOTE_DTYPE, copy=False), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_notes(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False).astype(NOTE_DTYPE, copy=False)
+
+
+def accepts_notes_array(accept: Optional[str]) -> bool:
+    """Whether a client listed `NOTES_MEDIA_TYPE` in its Accept header. JSON stays the default."""
+
+    return accept is not None and NOTES_MEDIA_TYPE in accept
+
+
+WAV_MEDIA_TYPE = "audio/wav"
+PCM_STREAM_MEDIA_TYPE = "application/octet-stream"
+
+
+def accepts_wav(accept: Optional[str]) -> bool:
+    """Whether a client listed `WAV_MEDIA_TYPE` in its Accept header. JSON stays the default."""
+
+    return accept is not None and WAV_MEDIA_TYPE in accept
+
+
+def accepts_pcm_stream(accept: Optional[str]) -> bool:
+    """Whether a client listed `PCM_STREAM_MEDIA_TYPE` in its Accept header, to receive audio as it is rendered."""
+
+    return accept is not None and PCM_STREAM_MEDIA_TYPE in accept
+
+
+def wav_bytes(audio: np.ndarray, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    wavfile.write(buffer, sample_rate, audio)
+    return buffer.getvalue()
+
+
+def trim_context(notes: NoteDicts, qpm: float, context_seconds: Optional[float]) -> Tuple[NoteDicts, float]:
+    """
+    Keep only the notes sounding in the last `context_seconds` of `notes`, moved so that the context starts at 0.
+
+    The context starts on a beat, so that the primer keeps its place on the beat grid. Notes that started before
+    the context are cut at its start.
+
+    Returns:
+        Tuple[NoteDicts, float]: The notes of the context, and the offset (in seconds) to add to generated notes to
+            put them back in place
+    """
+
+    if not context_seconds or not notes:
+        return notes, 0.0
+    last_end_time = max(note["start_time"] + note["duration"] for note in notes)
+    beat = 60 / qpm
+    offset = max(math.floor((last_end_time - context_seconds) / beat) * beat, 0.0)
+    context = []
+    for note in notes:
+        end_time = note["start_time"] + note["duration"]
+        if end_time <= offset:
+            continue
+        start_time = max(note["start_time"], offset)
+        context.append({**note, "start_time": start_time - offset, "duration": end_time - start_time})
+    return context, offset
+
+
 def change_tempo(seq: NoteSequence, new_tempo: float) -> NoteSequence:
     """
     Credit: https://stackoverflow.com/a/66074474
@@ -12,8 +12,9 @@ from pathlib import Path
 from typing import Literal
 
 import uvicorn
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, Request, Response, UploadFile
 from mustrans.types_ import NoteDicts
+from mustrans.utils import NOTES_MEDIA_TYPE, accepts_notes_array, encode_notes, notes2array
 
 
 @asynccontextmanager
@@ -36,6 +37,7 @@ async def main():
 async def music_transcription_with_transformers(
     model: Literal["ismir2021", "mt3"],
     audio_file: UploadFile,
+    request: Request,
     sample_rate: int = 16000,
 ) -> NoteDicts:
     audio_path = Path("tmp") / urllib.parse.quote(audio_file.filename)
@@ -52,7 +54,10 @@ async def music_transcription_with_transformers(
             capture_output=True,
             text=True,
         )
-        return json.loads(result.stdout.replace("'", "\""))
+        notes = json.loads(result.stdout.replace("'", "\""))
+        if accepts_notes_array(request.headers.get("accept")):
+            return Response(content=encode_notes(notes2array(notes)), media_type=NOTES_MEDIA_TYPE)
+        return notes
     finally:
         if audio_path.exists():
             audio_path.unlink()
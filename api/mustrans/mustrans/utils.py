@@ -2,8 +2,11 @@
 # File: utils.py
 
 import copy
+import io
+from typing import Optional
 
 import note_seq
+import numpy as np
 from note_seq.protobuf import music_pb2
 from note_seq.protobuf.music_pb2 import NoteSequence
 
@@ -38,6 +41,42 @@ def noteseq2notes(seq: NoteSequence) -> NoteDicts:
     ]
 
 
+NOTES_MEDIA_TYPE = "application/x-npy"
+NOTE_DTYPE = np.dtype([("note", "<i2"), ("start_time", "<f8"), ("duration", "<f8"), ("velocity", "<i2")])
+"""
+Columnar alternative to `NoteDicts`: a NumPy structured array with one typed field per key, sent as a `.npy` file
+with the `NOTES_MEDIA_TYPE` content type.
+"""
+
+
+def notes2array(notes: NoteDicts) -> np.ndarray:
+    array = np.empty(len(notes), dtype=NOTE_DTYPE)
+    for name in NOTE_DTYPE.names:
+        array[name] = [note[name] for note in notes]
+    return array
+
+
+def array2notes(array: np.ndarray) -> NoteDicts:
+    columns = [array[name].tolist() for name in NOTE_DTYPE.names]
+    return [dict(zip(NOTE_DTYPE.names, values)) for values in zip(*columns)]
+
+
+def encode_notes(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array.astype(NOTE_DTYPE, copy=False), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_notes(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False).astype(NOTE_DTYPE, copy=False)
+
+
+def accepts_notes_array(accept: Optional[str]) -> bool:
+    """Whether a client listed `NOTES_MEDIA_TYPE` in its Accept header. JSON stays the default."""
+
+    return accept is not None and NOTES_MEDIA_TYPE in accept
+
+
 def change_tempo(seq: NoteSequence, new_tempo: float) -> NoteSequence:
     """
     Credit: https://stackoverflow.com/a/66074474
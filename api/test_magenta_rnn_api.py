@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 # File: test_magenta_rnn_api.py
 
+import io
 import json
 
+import numpy as np
 import requests
 
 notes = [
@@ -55,3 +57,25 @@ for comb in musgen_combs:
     
     print(response)
     print("-" * 70 + "\n")
+
+print(f"----- Testing melody_rnn/basic_rnn with .npy note arrays -----")
+
+note_dtype = np.dtype([("note", "<i2"), ("start_time", "<f8"), ("duration", "<f8"), ("velocity", "<i2")])
+note_array = np.array([tuple(note.values()) for note in notes], dtype=note_dtype)
+buffer = io.BytesIO()
+np.save(buffer, note_array, allow_pickle=False)
+
+response = requests.request(
+    "POST",
+    "http://localhost:8100/melody_rnn/basic_rnn",
+    params=params,
+    headers={
+        "Accept": "application/x-npy",
+        "Content-Type": "application/x-npy",
+    },
+    data=buffer.getvalue(),
+)
+
+print(response.headers["Content-Type"])
+print(np.load(io.BytesIO(response.content), allow_pickle=False))
+print("-" * 70 + "\n")
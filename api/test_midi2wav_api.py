@@ -3,6 +3,7 @@
 # File: test_gansynth_api.py
 
 import mimetypes
+import time
 from pathlib import Path
 
 import numpy as np
@@ -31,3 +32,44 @@ with open(midi_path, "rb") as midi_file:
 # Output
 wav_path = f"midi2wav_{Path(midi_path).stem}.wav"
 save_wav(np.array(response["audio"], dtype=response["dtype"]), wav_path, sample_rate=response["sample_rate"])
+
+# Output as a WAV file
+with open(midi_path, "rb") as midi_file:
+    response = requests.request(
+        "POST",
+        "http://localhost:8100/midi2wav",
+        headers={
+            "Accept": "audio/wav",
+        },
+        files={
+            "midi_file": (Path(midi_path).name, midi_file, mimetypes.guess_type(midi_path)[0]),
+        },
+    )
+
+print(response.headers["Content-Type"], response.headers["X-Sample-Rate"], response.headers["X-Dtype"])
+with open(f"midi2wav_{Path(midi_path).stem}_binary.wav", "wb") as wav_file:
+    wav_file.write(response.content)
+
+# Output streamed while rendering
+with open(midi_path, "rb") as midi_file:
+    response = requests.request(
+        "POST",
+        "http://localhost:8100/midi2wav",
+        headers={
+            "Accept": "application/octet-stream",
+        },
+        files={
+            "midi_file": (Path(midi_path).name, midi_file, mimetypes.guess_type(midi_path)[0]),
+        },
+        stream=True,
+    )
+    start = time.perf_counter()
+    chunks = []
+    for chunk in response.iter_content(1 << 14):
+        if not chunks:
+            print(f"first chunk after {time.perf_counter() - start:.2f} s")
+        chunks.append(chunk)
+
+audio = np.frombuffer(b"".join(chunks), dtype=response.headers["X-Dtype"])
+audio = audio.reshape(-1, int(response.headers["X-Channels"]))
+save_wav(audio, f"midi2wav_{Path(midi_path).stem}_stream.wav", sample_rate=int(response.headers["X-Sample-Rate"]))
@@ -0,0 +1,202 @@
+import io
+import json
+import threading
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from classes.constants import *
+
+
+WAV_MEDIA_TYPE = "audio/wav"
+PCM_STREAM_MEDIA_TYPE = "application/octet-stream"
+NOTES_MEDIA_TYPE = "application/x-npy"
+NOTE_DTYPE = np.dtype([("note", "<i2"), ("start_time", "<f8"), ("duration", "<f8"), ("velocity", "<i2")])
+
+
+def note_dicts_to_array(note_dicts):
+    '''Converts notes with "note", "start_time", "duration" and "velocity" keys to a NOTE_DTYPE array.'''
+    array = np.empty(len(note_dicts), dtype=NOTE_DTYPE)
+    for name in NOTE_DTYPE.names:
+        array[name] = [note[name] for note in note_dicts]
+    return array
+
+
+def encode_notes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array.astype(NOTE_DTYPE, copy=False), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_notes(response: requests.Response):
+    '''Notes of a response as a NOTE_DTYPE array, whether the server answered with JSON or a .npy array.'''
+    if response.headers.get("Content-Type", "").startswith(NOTES_MEDIA_TYPE):
+        return np.load(io.BytesIO(response.content), allow_pickle=False).astype(NOTE_DTYPE, copy=False)
+    return note_dicts_to_array(response.json())
+
+
+def write_wav_response(response: requests.Response, path):
+    '''
+    Writes the body of a response straight to `path` if the server answered with a WAV file. Returns False if it
+    answered with JSON instead (servers that do not support binary audio).
+    '''
+    if not response.headers.get("Content-Type", "").startswith(WAV_MEDIA_TYPE):
+        return False
+    with open(path, "wb") as wav_file:
+        wav_file.write(response.content)
+    return True
+
+
+def read_pcm_stream(response: requests.Response, on_block=None, min_block_seconds=0.5, chunk_size=1 << 14):
+    '''
+    Reads raw PCM that the server streams while rendering (described by its X-Sample-Rate, X-Dtype and X-Channels
+    headers), for a request sent with `stream=True`. Calls `on_block(audio, sample_rate)` with every
+    `min_block_seconds` of float audio as soon as it has arrived, and returns `(audio, sample_rate)` with all of it.
+    Returns None if the server answered with something else (servers that do not stream audio).
+    '''
+    headers = response.headers
+    if not headers.get("Content-Type", "").startswith(PCM_STREAM_MEDIA_TYPE):
+        return None
+    sample_rate = int(headers["X-Sample-Rate"])
+    dtype = np.dtype(headers.get("X-Dtype", "<f4"))
+    channels = int(headers.get("X-Channels", 1))
+    frame_size = dtype.itemsize * channels
+    min_block_size = max(int(min_block_seconds * sample_rate), 1) * frame_size
+
+    blocks = []
+    pending = bytearray()
+
+    def flush():
+        size = len(pending) - len(pending) % frame_size     # a chunk may end in the middle of a frame
+        audio = np.frombuffer(bytes(pending[:size]), dtype=dtype)
+        del pending[:size]
+        if dtype.kind == "i":
+            audio = audio / -np.iinfo(dtype).min
+        audio = audio.astype(np.float32, copy=False)
+        if channels > 1:
+            audio = audio.reshape(-1, channels)
+        blocks.append(audio)
+        if on_block is not None:
+            on_block(audio, sample_rate)
+
+    try:
+        for chunk in response.iter_content(chunk_size):
+            pending.extend(chunk)
+            if len(pending) >= min_block_size:
+                flush()
+        if len(pending) >= frame_size:
+            flush()
+    finally:
+        response.close()
+    if not blocks:
+        return np.zeros((0, channels) if channels > 1 else 0, dtype=np.float32), sample_rate
+    return np.concatenate(blocks), sample_rate
+
+
+class LatencyStats():
+    '''
+    Number of calls, failures and round-trip times of one endpoint.
+    '''
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.last = 0.0
+
+    def record(self, seconds, failed):
+        self.calls += 1
+        self.failures += failed
+        self.total += seconds
+        self.slowest = max(self.slowest, seconds)
+        self.last = seconds
+
+    def __str__(self):
+        mean = self.total / self.calls if self.calls else 0.0
+        return f"{self.calls} calls, {self.failures} failed, mean {mean:.2f} s, max {self.slowest:.2f} s"
+
+
+class ApiClient():
+    '''
+    Client for one of the FastAPI servers (musgen or mustrans).
+
+    All calls share one keep-alive session with a connection pool, so repeated requests skip the TCP handshake.
+    Every call has a connect and a read timeout, connection failures and 502/503/504 answers are retried a bounded
+    number of times with exponential backoff, and the latency of every call is recorded per endpoint.
+    '''
+    def __init__(self, name, base_url, read_timeout, connect_timeout=API_CONNECT_TIMEOUT, retries=API_RETRIES,
+                 backoff=API_RETRY_BACKOFF, pool_size=4):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,                 # a timed-out generation would only time out again
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None,   # the endpoints have no side effects, so POST is safe to retry
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.stats = {}             # path -> LatencyStats
+        self.binary_notes = False   # whether the server has answered with a .npy note array, so it can read one too
+        self.stats_lock = threading.Lock()
+
+    def request(self, method, path, **kwargs) -> requests.Response:
+        '''
+        Sends a request to `path` on the server. Raises requests.exceptions.RequestException on connection errors,
+        timeouts and error statuses.
+        '''
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            response.raise_for_status()
+            failed = False
+            return response
+        finally:
+            with self.stats_lock:
+                self.stats.setdefault(path, LatencyStats()).record(time.perf_counter() - start, failed)
+
+    def post(self, path, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def post_notes(self, path, note_dicts, **kwargs):
+        '''
+        Posts notes and returns the notes of the answer as a NOTE_DTYPE array.
+
+        Notes are sent and received as .npy arrays once the server has shown it supports them by answering with one,
+        and as JSON until then, so older servers keep working.
+        '''
+        headers = {"Accept": f"{NOTES_MEDIA_TYPE}, application/json;q=0.9"}
+        if self.binary_notes:
+            headers["Content-Type"] = NOTES_MEDIA_TYPE
+            data = encode_notes(note_dicts_to_array(note_dicts))
+        else:
+            headers["Content-Type"] = "application/json"
+            data = json.dumps(note_dicts)
+        response = self.post(path, headers=headers, data=data, **kwargs)
+        self.binary_notes = response.headers.get("Content-Type", "").startswith(NOTES_MEDIA_TYPE)
+        return decode_notes(response)
+
+    def report(self):
+        with self.stats_lock:
+            return [f"{self.name} {path}: {stats}" for path, stats in sorted(self.stats.items())]
+
+
+MUSGEN = ApiClient("musgen", MUSGEN_URL, read_timeout=MUSGEN_READ_TIMEOUT, pool_size=12)  # Generate All
+MUSTRANS = ApiClient("mustrans", MUSTRANS_URL, read_timeout=MUSTRANS_READ_TIMEOUT)
+
+
+def print_latency_report():
+    for line in MUSGEN.report() + MUSTRANS.report():
+        print(line)
@@ -0,0 +1,79 @@
+import time
+from collections import deque
+
+import pygame
+import requests
+
+import classes.synth as synth
+from classes.jobs import BackgroundJob, JobCancelled
+
+
+class AudioStream(BackgroundJob):
+    '''
+    Plays audio from the server while it is still being rendered and downloaded, instead of after the whole file.
+
+    `fetch(on_block)` runs on a worker thread and calls `on_block(audio, sample_rate)` for every block of float audio
+    as it arrives (e.g. gansynth with read_pcm_stream). Blocks are turned into pygame Sounds there, and `update()`
+    hands them to one mixer channel from the main loop, queueing the next block while the current one plays, so
+    playback starts with the first block.
+    '''
+    def __init__(self, fetch, name):
+        super().__init__(name)
+        self.fetch = fetch
+        self.sounds = deque()           # Sounds received but not handed to the channel yet
+        self.received_seconds = 0.0
+        self.first_sound_time = None    # seconds from the request to the first block playing
+        self.channel = None
+        if pygame.mixer.get_init() is None:
+            print('Mixer is not initialized, audio is only saved, not played while streaming.')
+        else:
+            self.channel = pygame.mixer.Channel(pygame.mixer.get_num_channels() - 1)
+
+    def playing(self):
+        return bool(self.sounds) or (self.channel is not None and self.channel.get_busy())
+
+    def on_block(self, audio, sample_rate):
+        if self.cancelled:
+            raise JobCancelled()
+        self.received_seconds += len(audio) / sample_rate
+        if self.channel is not None:
+            self.sounds.append(pygame.mixer.Sound(file=synth.to_wav(audio, sample_rate)))
+
+    def stop(self):
+        self.cancelled = True
+        self.sounds.clear()
+        if self.channel is not None:
+            self.channel.stop()
+
+    def work(self):
+        self.fetch(self.on_block)
+
+    def report_error(self, e):
+        if isinstance(e, requests.exceptions.RequestException):
+            print(f"Error connecting to API: {e}")
+        else:
+            print(f"Error streaming {self.name}: {e}")
+
+    def update(self):
+        '''keeps one block playing and the next one queued'''
+        if self.channel is None or self.cancelled:
+            return
+        while self.sounds and self.channel.get_queue() is None:
+            sound = self.sounds.popleft()
+            if self.channel.get_busy():
+                self.channel.queue(sound)
+            else:
+                self.channel.play(sound)
+                if self.first_sound_time is None:
+                    self.first_sound_time = time.perf_counter() - self.start_time
+
+    def status_text(self):
+        if self.cancelled:
+            return f"{self.name}: stopped"
+        if self.error is not None:
+            return f"{self.name}: failed ({self.error.__class__.__name__})"
+        text = f"{self.name}: {self.received_seconds:.1f} s of audio"
+        text += f" in {self.elapsed():.1f} s" if self.done() else f", streaming ({self.elapsed():.1f} s)"
+        if self.first_sound_time is not None:
+            text += f", first sound after {self.first_sound_time:.1f} s"
+        return text
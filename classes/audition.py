@@ -0,0 +1,44 @@
+import numpy as np
+import pygame
+
+import classes.synth as synth
+
+
+class Audition():
+    '''
+    Plays a short preview of a pitch when a note is clicked or dragged in the piano roll.
+
+    Every pitch is rendered once with the built-in synth and kept in a pygame Sound, so a preview only hands an
+    in-memory buffer to the mixer. Previews play on a small pool of reserved mixer channels, oldest voice first, so
+    they never take the channels of other sounds and a fast drag cannot pile up voices.
+    '''
+    def __init__(self, n_voices=4, seconds=0.4, pitches=range(128)):
+        self.sounds = {}
+        self.voices = []
+        self.next_voice = 0
+        mixer_format = pygame.mixer.get_init()
+        if mixer_format is None:
+            print('Mixer is not initialized, note audition is disabled.')
+            return
+        sr, _, n_channels = mixer_format
+
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), n_voices + 8))
+        pygame.mixer.set_reserved(n_voices)
+        self.voices = [pygame.mixer.Channel(i) for i in range(n_voices)]
+
+        wavetable = synth.make_wavetable()
+        for pitch in pitches:
+            audio = synth.render_notes([pitch], [0.0], [seconds], [127], sr=sr, wavetable=wavetable)
+            samples = synth.to_pcm16(audio)
+            if n_channels > 1:
+                samples = np.repeat(samples[:, np.newaxis], n_channels, axis=1)
+            self.sounds[pitch] = pygame.sndarray.make_sound(np.ascontiguousarray(samples))
+
+    def play(self, pitch, velocity=80):
+        sound = self.sounds.get(pitch)
+        if sound is None or not self.voices:
+            return
+        voice = self.voices[self.next_voice]
+        self.next_voice = (self.next_voice + 1) % len(self.voices)
+        voice.set_volume(velocity / 127)
+        voice.play(sound)
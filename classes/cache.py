@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from classes.constants import *
+
+CACHE_VERSION = 2           # bump when a transcription algorithm changes its output (2: MT3 on 16 kHz mono uploads)
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    '''SHA-256 of the content of a file, read in chunks.'''
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TranscriptionCache():
+    '''
+    On-disk cache of transcription features and results, keyed by audio content and transcription parameters.
+
+    Every entry is a compressed `.npz` file of NumPy arrays. Reading an entry refreshes its modification time, and
+    the least recently used entries are deleted once the cache grows beyond `max_bytes`.
+    '''
+    def __init__(self, directory=TRANSCRIPTION_CACHE_DIRECTORY, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, digest, stage, **params):
+        '''Key of the entry for one stage (e.g. "librosa", "mt3") of a file with content hash `digest`.'''
+        payload = json.dumps([CACHE_VERSION, digest, stage, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        '''Returns the arrays stored under `key` as a dictionary, or None on a miss.'''
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = {name: data[name] for name in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:     # evicted by another process since it was loaded, still a hit
+            pass
+        return entry
+
+    def put(self, key, **arrays):
+        '''Stores `arrays` under `key`, then evicts old entries if the cache is too large.'''
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temp_path, path)  # readers never see a partially written entry
+        self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used entries until the cache fits in `max_bytes`.'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:     # removed by another process in the meantime
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+TRANSCRIPTION_CACHE = TranscriptionCache()
@@ -1,3 +1,5 @@
+import os
+
 import pygame
 
 SCREEN_WIDTH = 1200
@@ -20,6 +22,36 @@ OUTPUTS_WIDTH = OUTPUTS_RIGHT_BOUND - OUTPUTS_LEFT_BOUND
 OUTPUTS_HEIGHT = OUTPUTS_DOWN_BOUND - OUTPUTS_UP_BOUND
 
 TEMP_MUSIC_DIRECTORY = "temp_music"
+TRANSCRIPTION_CACHE_DIRECTORY = "transcription_cache"
+
+# API servers, overridable with environment variables
+MUSGEN_URL = os.environ.get("MUSGEN_URL", "http://localhost:8100")
+MUSTRANS_URL = os.environ.get("MUSTRANS_URL", "http://localhost:8200")
+API_CONNECT_TIMEOUT = 3.05      # seconds
+MUSGEN_READ_TIMEOUT = 300       # generating long extensions with performance_rnn is slow
+MUSTRANS_READ_TIMEOUT = 600
+API_RETRIES = 2
+API_RETRY_BACKOFF = 0.5         # seconds, doubled on every retry
+
+# Continuations are requested in the background once the piano roll and generation settings are left alone for
+# SPECULATION_IDLE_MS, with at most SPECULATION_MAX_JOBS requests at once; set SPECULATION_MAX_JOBS = 0 to disable
+SPECULATION_IDLE_MS = 1500
+SPECULATION_MAX_JOBS = 1
+
+# Generate: only the notes of the last GENERATION_CONTEXT_SECONDS are sent to the musgen models (None sends all)
+GENERATION_CONTEXT_SECONDS = 30
+
+# Generate: if the selected model has not answered after GENERATION_BUDGET_SECONDS, the Markov continuation computed
+# alongside it is used instead, until the model's answer arrives
+GENERATION_BUDGET_SECONDS = 8
+
+# Generate All: seconds each model has to answer before it is left out of the candidates
+FANOUT_BUDGET_SECONDS = 60
+
+# How Quick Play and Export WAV turn notes into sound:
+# "builtin" renders them with classes/synth.py, "server" plays MIDI through the system synth and exports with the
+# FluidSynth-backed /midi2wav endpoint of the musgen server
+RENDERER = "builtin"
 
 INPUTS_LEFT_BOUND = 0
 INPUTS_RIGHT_BOUND = SCREEN_WIDTH
@@ -30,6 +62,9 @@ INPUTS_HEIGHT = INPUTS_DOWN_BOUND - INPUTS_UP_BOUND
 
 DOUBLE_CLICK_TIME = 300
 FPS = 60
+MIXER_BUFFER = 512          # samples; also the latency of note audition
+
+PLAYBACK_END_EVENT = pygame.USEREVENT + 1
 
 BLACK = (0, 0, 0)
 DARK_GREY = (64, 64, 64)
@@ -1,11 +1,9 @@
+import io
 import os
 import math
 import platform
 import tkinter
-import mimetypes
 import requests
-import wave
-import threading
 from tkinter.filedialog import askopenfilename
 from pathlib import Path
 
@@ -13,11 +11,15 @@ import librosa
 import mido
 import numpy as np
 import pygame
-import pyaudio
+import soundfile
 
+from classes.api_client import MUSTRANS, NOTES_MEDIA_TYPE, decode_notes
+from classes.cache import TRANSCRIPTION_CACHE, file_digest
 from classes.constants import *
+from classes.jobs import ImportQueue
 from classes.ui_elements import Button
 from classes.pianoroll import Note, PianoRoll
+from classes.recorder import ANALYSIS_SR, LiveRecorder, MicrophoneSource
 
 
 def midi_to_dict(filename):
@@ -47,26 +49,192 @@ def midi_to_dict(filename):
     return note_dict_list
 
 
-def read_midi(filename, piano_roll: PianoRoll):
+def add_note_arrays(piano_roll: PianoRoll, notes):
+    '''Adds notes stored as "pitch", "start", "duration" and "velocity" arrays (in ticks) to the piano roll.'''
+    piano_roll.add_notes([
+        Note(int(pitch), float(start), float(duration), int(velocity))
+        for pitch, start, duration, velocity in zip(notes["pitch"], notes["start"], notes["duration"], notes["velocity"])
+    ])
+
+
+def add_cached_notes(piano_roll: PianoRoll, key):
+    '''Adds the transcription cached under `key` to the piano roll. Returns False on a cache miss.'''
+    cached = TRANSCRIPTION_CACHE.get(key)
+    if cached is None:
+        return False
+    piano_roll.bpm = int(cached["bpm"])
+    add_note_arrays(piano_roll, cached)
+    print("Done! (cached)")
+    return True
+
+
+def report_progress(progress, fraction, stage):
+    '''Reports to the `progress(fraction, stage)` callback of an import job, if any.'''
+    if progress is not None:
+        progress(fraction, stage)
+
+
+def read_midi(filename, piano_roll: PianoRoll, progress=None):
     note_dict_list = midi_to_dict(filename)
     smallest_time = int(TICKS_IN_BEAT / 4)
+    new_notes = []
     for note in note_dict_list:
         note["start_time"] = round(note["start_time"] / smallest_time) * smallest_time
         note["duration"] = math.ceil(note["duration"] / smallest_time) * smallest_time
-        new_note = Note(note["note"], note["start_time"], note["duration"], note["velocity"])
-        piano_roll.add_note(new_note)
-
-
-def read_librosa(filename, piano_roll: PianoRoll):
+        new_notes.append(Note(note["note"], note["start_time"], note["duration"], note["velocity"]))
+    piano_roll.add_notes(new_notes)
+
+
+PITCH_METHODS = ("piptrack", "harmonic", "cqt")
+
+
+def estimate_onset_pitches(y, sr, S, onset_frame, method="piptrack", window=0, hop_length=512, n_harmonics=5):
+    """
+    Estimate the most significant pitch (in Hz) at each onset.
+
+    Only the spectrogram frames in `[t, t + window]` of every onset frame `t` are analysed, so the cost grows with
+    the number of onsets instead of the length of the audio.
+
+    Args:
+        y (np.ndarray): Audio time series
+        sr (int): Sample rate of `y`
+        S (np.ndarray): Magnitude spectrogram of `y` (freq x frames), or only its columns around the onsets. \
+            Not used by the "cqt" method, which may be given None.
+        onset_frame (np.ndarray): Onset frame indices
+        method (str, optional): "piptrack" (parabolic peak of the loudest bin), "harmonic" (harmonic sum over \
+            MIDI pitch candidates) or "cqt" (loudest bin of a CQT computed on short segments around the onsets). \
+            Defaults to "piptrack".
+        window (int, optional): Number of frames after the onset frame to also consider. Defaults to 0.
+        hop_length (int, optional): Hop length used to compute `S`. Defaults to 512.
+        n_harmonics (int, optional): Number of harmonics summed by the "harmonic" method. Defaults to 5.
+
+    Returns:
+        np.ndarray: Pitch (in Hz) of each onset
+    """
+
+    assert method in PITCH_METHODS, f"Unknown pitch method \"{method}\""
+    onset_frame = np.asarray(onset_frame, dtype=int)
+    if len(onset_frame) == 0:
+        return np.zeros(0)
+
+    if S is not None:
+        # (n_onsets, window + 1) frame indices, clipped to the spectrogram
+        frames = np.minimum(onset_frame[:, None] + np.arange(window + 1)[None, :], S.shape[1] - 1)
+
+    if method == "piptrack":
+        # piptrack works column by column, so running it on the onset columns only gives the same result
+        pitches, magnitudes = librosa.piptrack(S=S[:, frames.ravel()], sr=sr, hop_length=hop_length)
+        best_bin = magnitudes.argmax(axis=0)
+        columns = np.arange(magnitudes.shape[1])
+        pitch = pitches[best_bin, columns].reshape(frames.shape)
+        strength = magnitudes[best_bin, columns].reshape(frames.shape)
+
+    elif method == "harmonic":
+        n_fft = 2 * (S.shape[0] - 1)
+        f0 = librosa.midi_to_hz(np.arange(21, 109))  # A0 to C8
+        harmonics = np.arange(1, n_harmonics + 1)
+        bins = np.rint(harmonics[:, None] * f0[None, :] * n_fft / sr).astype(int)  # (n_harmonics, n_f0)
+        valid = bins < S.shape[0]
+        weights = (0.8 ** (harmonics - 1))[:, None] * valid
+        S_onsets = S[:, frames.ravel()]
+        salience = np.einsum("hp,hpt->pt", weights, S_onsets[np.minimum(bins, S.shape[0] - 1)])
+        best = salience.argmax(axis=0)
+        pitch = f0[best].reshape(frames.shape)
+        strength = salience.max(axis=0).reshape(frames.shape)
+
+    else:
+        # CQT of short segments starting at each onset, batched as a multichannel signal
+        seg_len = max(4096, (window + 1) * hop_length)
+        starts = onset_frame * hop_length
+        y_padded = np.pad(y, (0, seg_len))
+        segments = y_padded[starts[:, None] + np.arange(seg_len)[None, :]]
+        C = np.abs(librosa.cqt(segments, sr=sr, hop_length=hop_length, fmin=librosa.note_to_hz("A0"), n_bins=88))
+        C = C[..., :window + 1]  # (n_onsets, 88, window + 1)
+        best_bin = C.argmax(axis=1)
+        pitch = librosa.midi_to_hz(21 + best_bin)
+        strength = C.max(axis=1)
+
+    # keep the frame with the strongest pitch in each onset window
+    return pitch[np.arange(len(onset_frame)), strength.argmax(axis=1)]
+
+
+def frame_loudness(y, sr, frames=(), n_fft=2048, hop_length=512, block_frames=1024):
+    """
+    Perceptually weighted loudness of every STFT frame of `y`, computed over blocks of frames so that the whole
+    spectrogram is never kept in memory.
+
+    The result matches `librosa.stft(y)` followed by `librosa.perceptual_weighting` (with its 80 dB floor below the
+    loudest bin) and converted back to amplitudes averaged over frequencies. The floor depends on the whole file, so
+    the blocks are transformed twice: once for the loudest bin, once for the loudness.
+
+    Args:
+        y (np.ndarray): Audio time series
+        sr (int): Sample rate of `y`
+        frames (np.ndarray, optional): Frames whose magnitude spectrum is also returned. Defaults to none.
+        n_fft (int, optional): FFT size. Defaults to 2048.
+        hop_length (int, optional): Hop length. Defaults to 512.
+        block_frames (int, optional): Number of frames transformed at once. Defaults to 1024.
+
+    Returns:
+        np.ndarray: Loudness of each frame
+        np.ndarray: Magnitude spectrum of each of `frames` (freq x len(frames))
+    """
+
+    frames = np.asarray(frames, dtype=int)
+    y_padded = np.pad(y, n_fft // 2)   # centered frames, like librosa.stft
+    n_frames = 1 + len(y) // hop_length
+    weights = librosa.frequency_weighting(librosa.fft_frequencies(sr=sr, n_fft=n_fft))[:, np.newaxis]
+
+    def blocks():
+        for first in range(0, n_frames, block_frames):
+            last = min(first + block_frames, n_frames)
+            segment = y_padded[first * hop_length:(last - 1) * hop_length + n_fft]
+            yield first, np.abs(librosa.stft(segment, n_fft=n_fft, hop_length=hop_length, center=False))
+
+    top = max(librosa.power_to_db(np.square(S.max()), top_db=None) for _, S in blocks())
+    loudness = np.empty(n_frames)
+    columns = np.empty((1 + n_fft // 2, len(frames)), dtype=np.float32)
+    for first, S in blocks():
+        S_db = np.maximum(librosa.power_to_db(np.square(S), top_db=None), top - 80.0) + weights
+        loudness[first:first + S.shape[1]] = np.mean(librosa.db_to_amplitude(S_db), axis=0)
+        inside = (frames >= first) & (frames < first + S.shape[1])
+        columns[:, inside] = S[:, frames[inside] - first]
+    return loudness, columns
+
+
+def read_librosa(filename, piano_roll: PianoRoll, pitch_method="piptrack", pitch_window=0, progress=None):
+    digest = file_digest(filename)
+    result_key = TRANSCRIPTION_CACHE.key(digest, "librosa", pitch_method=pitch_method, pitch_window=pitch_window)
+    if add_cached_notes(piano_roll, result_key):
+        return
+
+    report_progress(progress, 0.0, "decoding")
     y, sr = librosa.load(filename)
 
-    # both usual and backtrack onsets are used
-    onset_frame = librosa.onset.onset_detect(y=y, sr=sr)
-    onset_time_backtrack = librosa.onset.onset_detect(y=y, sr=sr, backtrack=True, units="time")
+    features_key = TRANSCRIPTION_CACHE.key(digest, "librosa_features", sr=sr)
+    features = TRANSCRIPTION_CACHE.get(features_key)
+    if features is None:
+        report_progress(progress, 0.2, "onsets")
+        # both usual and backtrack onsets are used
+        onset_frame = librosa.onset.onset_detect(y=y, sr=sr)
+        onset_time_backtrack = librosa.onset.onset_detect(y=y, sr=sr, backtrack=True, units="time")
+
+        # track bpm
+        report_progress(progress, 0.4, "tempo")
+        bpm, beats = librosa.beat.beat_track(y=y, sr=sr)
+        features = {
+            "sr": sr,
+            "n_samples": len(y),
+            "onset_frame": onset_frame,
+            "onset_time_backtrack": onset_time_backtrack,
+            "bpm": bpm,
+            "beats": beats,
+        }
+        TRANSCRIPTION_CACHE.put(features_key, **features)
 
-    # track bpm
-    bpm, beats = librosa.beat.beat_track(y=y, sr=sr)
-    bpm = int(round(bpm))
+    onset_frame = features["onset_frame"]
+    onset_time_backtrack = features["onset_time_backtrack"]
+    bpm = int(round(float(np.atleast_1d(features["bpm"])[0])))
     piano_roll.bpm = bpm
 
     onset_tick = onset_time_backtrack * TICKS_IN_BEAT / (60 / bpm)
@@ -89,25 +257,26 @@ def read_librosa(filename, piano_roll: PianoRoll):
                 note_duration_list[i-1] += 1
                 j += (TICKS_IN_BEAT / 4)
                 
-    # for computing pitch
-    S = np.abs(librosa.stft(y))
-    pitches_frame, magnitudes = librosa.piptrack(S=S, sr=sr)
-
-    # for computing the loudness / velocity
-    S_db = np.square(S)
-    freqs = librosa.fft_frequencies(sr=sr)
-    S_db = librosa.perceptual_weighting(S_db, freqs)
-
-    # sum and normalize the loudnesses
-    velocity = librosa.db_to_amplitude(S_db)
-    velocity_sum = np.mean(velocity, axis=0)
+    # loudness of every frame, and the spectrum only around the onsets for computing pitch
+    report_progress(progress, 0.6, "pitch")
+    onset_frame = np.asarray(onset_frame, dtype=int)
+    n_frames = 1 + len(y) // 512
+    if pitch_method == "cqt":
+        velocity_sum, _ = frame_loudness(y, sr)
+        onset_pitch = estimate_onset_pitches(y, sr, None, onset_frame, method=pitch_method, window=pitch_window)
+    else:
+        onset_windows = np.minimum(onset_frame[:, None] + np.arange(pitch_window + 1)[None, :], n_frames - 1)
+        velocity_sum, S_onsets = frame_loudness(y, sr, onset_windows.ravel())
+        # the onset windows are side by side in S_onsets
+        onset_pitch = estimate_onset_pitches(y, sr, S_onsets, np.arange(len(onset_frame)) * (pitch_window + 1),
+                                             method=pitch_method, window=pitch_window)
+
+    # normalize the loudnesses
     velocity_sum = velocity_sum * 127 / np.max(velocity_sum)
 
     pitches_tick = []
     for i, t in enumerate(onset_frame):
-        # finsing the most significant pitch
-        index = magnitudes[:, t].argmax()
-        pitch = pitches_frame[index, t]
+        pitch = onset_pitch[i]
 
         onset_velocity = velocity_sum[t]
         duration = (TICKS_IN_BEAT / 4)
@@ -122,50 +291,431 @@ def read_librosa(filename, piano_roll: PianoRoll):
 
         pitches_tick.append({"frame": t, "note": librosa.hz_to_note(min(pitch, 20000)), "duration":duration, "velocity": int(onset_velocity)})
 
-    for i in range(len(onset_tick)):
-        piano_roll.add_note(Note(librosa.note_to_midi(pitches_tick[i]["note"]), onset_tick[i], pitches_tick[i]["duration"], pitches_tick[i]["velocity"]))
+    notes = {
+        "pitch": np.array([librosa.note_to_midi(p["note"]) for p in pitches_tick], dtype=np.int16),
+        "start": onset_tick,
+        "duration": np.array([p["duration"] for p in pitches_tick], dtype=float),
+        "velocity": np.array([p["velocity"] for p in pitches_tick], dtype=np.int16),
+    }
+    TRANSCRIPTION_CACHE.put(result_key, bpm=bpm, **notes)
+    add_note_arrays(piano_roll, notes)
     
     print("Done!")
 
 
-def read_mt3(filename, piano_roll: PianoRoll):
+def detect_polyphonic_pitches(C, onset_frame, threshold=0.2, max_polyphony=6, n_harmonics=6):
+    """
+    Pick the pitches that start at each onset from a semitone CQT, suppressing the overtones of lower notes.
+
+    Args:
+        C (np.ndarray): CQT magnitude with 12 bins per octave starting at A0 (pitch x frames)
+        onset_frame (np.ndarray): Onset frame indices
+        threshold (float, optional): Minimum magnitude after suppression, relative to the loudest bin of the onset \\
+            frame. Defaults to 0.2.
+        max_polyphony (int, optional): Maximum number of notes per onset. Defaults to 6.
+        n_harmonics (int, optional): Number of overtones suppressed above each peak. Defaults to 6.
+
+    Returns:
+        np.ndarray: Boolean mask (pitch x onsets) of the detected notes
+    """
+
+    n_bins = C.shape[0]
+    C_on = C[:, onset_frame]
+
+    # local maxima along the pitch axis
+    padded = np.pad(C_on, ((1, 1), (0, 0)))
+    peaks = (C_on >= padded[:-2]) & (C_on > padded[2:])
+
+    # remove from every bin the overtone energy expected from the peaks below it
+    offsets = np.rint(12 * np.log2(np.arange(2, n_harmonics + 2))).astype(int)  # 12, 19, 24, 28, 31, 34, ...
+    suppression = np.zeros((n_bins, n_bins))
+    for offset, weight in zip(offsets, 0.8 ** np.arange(1, n_harmonics + 1)):
+        suppression += weight * np.eye(n_bins, k=-offset)
+    salience = C_on - suppression @ (C_on * peaks)
+
+    notes = peaks & (salience > threshold * C_on.max(axis=0))
+
+    # only keep pitches that got louder, so that held notes are not restarted by every onset
+    before = C[:, np.maximum(onset_frame - 2, 0)]
+    notes &= (C_on > before * 1.1) | (onset_frame < 2)
+
+    # keep the `max_polyphony` most salient notes of each onset
+    order = np.argsort(np.where(notes, -salience, np.inf), axis=0)
+    rank = np.argsort(order, axis=0)
+    return notes & (rank < max_polyphony)
+
+
+def polyphonic_note_ends(C, onset_frame, pitch_idx, onset_idx, decay=0.1, max_frames=400):
+    """
+    Find the end frame of each note: the first frame where its CQT bin falls below `decay` times its onset magnitude,
+    or where the same pitch starts again, whichever comes first.
+    """
+
+    starts = onset_frame[onset_idx]
+    frames = starts[:, None] + np.arange(max_frames)[None, :]
+    in_range = frames < C.shape[1]
+    magnitude = C[pitch_idx[:, None], np.minimum(frames, C.shape[1] - 1)]
+
+    # start of the next note with the same pitch
+    order = np.lexsort((starts, pitch_idx))
+    same_pitch = pitch_idx[order][1:] == pitch_idx[order][:-1]
+    next_start = np.empty(len(starts))
+    next_start[order] = np.append(np.where(same_pitch, starts[order][1:], np.inf), np.inf)
+
+    ended = (magnitude < decay * magnitude[:, :1]) | ~in_range | (frames >= next_start[:, None])
+    ended[:, 0] = False
+    length = np.where(ended.any(axis=1), ended.argmax(axis=1), max_frames)
+    return starts + length
+
+
+def read_librosa_poly(filename, piano_roll: PianoRoll, hop_length=512, max_polyphony=6, progress=None):
+    '''
+    Polyphonic version of read_librosa: every onset can start several notes, picked from a CQT.
+    '''
+    key = TRANSCRIPTION_CACHE.key(file_digest(filename), "librosa_poly", hop_length=hop_length,
+                                  max_polyphony=max_polyphony)
+    if add_cached_notes(piano_roll, key):
+        return
+
+    report_progress(progress, 0.0, "decoding")
     y, sr = librosa.load(filename)
 
+    report_progress(progress, 0.3, "onsets")
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+    onset_frame = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    onset_time = librosa.frames_to_time(librosa.onset.onset_backtrack(onset_frame, onset_env),
+                                        sr=sr, hop_length=hop_length)
+
     # track bpm
+    bpm, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    bpm = int(round(float(np.atleast_1d(bpm)[0])))
+    piano_roll.bpm = bpm
+    if len(onset_frame) == 0:
+        return
+
+    report_progress(progress, 0.5, "pitch")
+    C = np.abs(librosa.cqt(y, sr=sr, hop_length=hop_length, fmin=librosa.note_to_hz("A0"), n_bins=88))
+    pitch_idx, onset_idx = np.nonzero(detect_polyphonic_pitches(C, onset_frame, max_polyphony=max_polyphony))
+    end_frame = polyphonic_note_ends(C, onset_frame, pitch_idx, onset_idx)
+
+    # quantize to the nearest 16th note
+    sixteenth = TICKS_IN_BEAT / 4
+    to_tick = TICKS_IN_BEAT / (60 / bpm)
+    start_tick = np.round(onset_time[onset_idx] * to_tick / sixteenth) * sixteenth
+    duration_time = (end_frame - onset_frame[onset_idx]) * hop_length / sr
+    duration_tick = np.maximum(1, np.round(duration_time * to_tick / sixteenth)) * sixteenth
+
+    magnitude = C[pitch_idx, onset_frame[onset_idx]]
+    velocity = np.clip(np.sqrt(magnitude / magnitude.max()) * 127, 1, 127).astype(int)
+
+    notes = {
+        "pitch": (pitch_idx + 21).astype(np.int16),
+        "start": start_tick,
+        "duration": duration_tick,
+        "velocity": velocity.astype(np.int16),
+    }
+    TRANSCRIPTION_CACHE.put(key, bpm=bpm, **notes)
+    add_note_arrays(piano_roll, notes)
+
+    print("Done!")
+
+
+STREAM_MIN_DURATION = 60    # seconds, longer audio files are transcribed block by block
+RECORDING_PATH = "inputs/recording.wav"
+
+
+def stream_frame_length(sr):
+    '''FFT size used by StreamTranscriber, about 93 ms whatever the sample rate.'''
+    return 2048 if sr <= 22050 else 4096
+
+
+class StreamTranscriber():
+    '''
+    Block-by-block version of the Librosa transcription, for audio too long to be loaded at once.
+
+    Consecutive blocks must overlap by `n_fft - hop_length` samples (as produced by `librosa.stream`), so that their
+    frames form one continuous spectrogram. Onset, loudness and tempo state are carried across blocks, and every note
+    is passed to `on_note` as soon as the next onset (or the end of the audio) fixes its duration.
+
+    In `live` mode, a note is passed to `on_note` as soon as its onset is detected, and `on_resize(note, duration)`
+    is called whenever its duration is extended while it keeps sounding (e.g. PianoRoll.post_resize, as the note may
+    already be in the piano roll).
+    '''
+    def __init__(self, sr, on_note, bpm=None, n_fft=2048, hop_length=512, pitch_method="piptrack",
+                 pitch_window=0, tempo_seconds=10, post_avg_seconds=0.10, live=False, on_resize=None):
+        self.sr = sr
+        self.on_note = on_note
+        self.on_resize = on_resize
+        self.bpm = bpm                  # estimated from the first `tempo_seconds` of audio if None
+        self.live = live
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.pitch_method = pitch_method
+        self.pitch_window = pitch_window
+        self.tempo_frames = int(tempo_seconds * sr / hop_length)
+
+        # peak picking parameters of librosa.onset.onset_detect
+        self.pre_max = int(0.03 * sr // hop_length)
+        self.post_max = int(0.00 * sr // hop_length + 1)
+        self.pre_avg = int(0.10 * sr // hop_length)
+        self.post_avg = int(post_avg_seconds * sr // hop_length + 1)   # look-ahead, shortened for live use
+        self.wait = int(0.03 * sr // hop_length)
+        self.lookahead = max(self.post_max, self.post_avg, pitch_window + 1)
+
+        # histories of the most recent frames, `offset` is the global frame index of their first column
+        self.offset = 0
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.spec = np.zeros((n_fft // 2 + 1, 0), dtype=np.float32)
+        self.loudness = np.zeros(0)
+        self.envelope = np.zeros(0)
+        self.n_frames = 0               # total number of frames seen so far
+
+        self.prev_mel = None
+        self.envelope_max = 0
+        self.loudness_max = 0
+        self.tempo_envelope = []
+        self.picked_until = 0           # frames before this have been peak picked
+        self.last_onset = -self.wait - 1
+        self.onsets = []                # onsets whose note has not been emitted yet
+        self.last_tick = None
+
+    def push(self, block):
+        '''Analyses the next audio block.'''
+        S = np.abs(librosa.stft(block, n_fft=self.n_fft, hop_length=self.hop_length, center=False))
+        new_audio = block if self.n_frames == 0 else block[self.n_fft - self.hop_length:]
+        self.audio = np.concatenate([self.audio, new_audio])
+        self.spec = np.concatenate([self.spec, S], axis=1)
+        self.n_frames += S.shape[1]
+
+        # loudness, as in read_librosa
+        S_db = librosa.perceptual_weighting(np.square(S), librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft))
+        loudness = np.mean(librosa.db_to_amplitude(S_db), axis=0)
+        self.loudness = np.concatenate([self.loudness, loudness])
+        self.loudness_max = max(self.loudness_max, loudness.max())
+
+        # onset strength, continued from the last frame of the previous block
+        mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=np.square(S), sr=self.sr), top_db=None)
+        mel_db = np.concatenate([mel_db[:, :1] if self.prev_mel is None else self.prev_mel, mel_db], axis=1)
+        self.prev_mel = mel_db[:, -1:]
+        envelope = np.maximum(0, np.diff(mel_db, axis=1)).mean(axis=0)
+        self.envelope = np.concatenate([self.envelope, envelope])
+        self.envelope_max = max(self.envelope_max, envelope.max())
+
+        if self.bpm is None:
+            self.tempo_envelope.append(envelope)
+            if sum(len(e) for e in self.tempo_envelope) >= self.tempo_frames:
+                self.lock_bpm()
+
+        self.pick_onsets(final=False)
+        self.emit_notes(final=False)
+        self.trim()
+
+    def finish(self):
+        '''Flushes the remaining onsets and notes at the end of the audio.'''
+        if self.bpm is None:
+            self.lock_bpm()
+        self.pick_onsets(final=True)
+        self.emit_notes(final=True)
+
+    def lock_bpm(self):
+        envelope = np.concatenate(self.tempo_envelope) if self.tempo_envelope else np.zeros(1)
+        bpm, _ = librosa.beat.beat_track(onset_envelope=envelope, sr=self.sr, hop_length=self.hop_length)
+        bpm = int(round(float(np.atleast_1d(bpm)[0])))
+        self.bpm = bpm if bpm > 0 else 120
+        self.tempo_envelope = []
+
+    def frame_to_time(self, frame):
+        # frames are not centered, so a frame's time is the middle of its window
+        return (frame * self.hop_length + self.n_fft // 2) / self.sr
+
+    def tick_to_frame(self, tick):
+        time = tick * (60 / self.bpm) / TICKS_IN_BEAT
+        return int((time * self.sr - self.n_fft // 2) // self.hop_length)
+
+    def pick_onsets(self, final):
+        '''Peak picks the onset envelope up to the frames whose look-ahead is complete.'''
+        usable = len(self.envelope) if final else len(self.envelope) - self.lookahead
+        if usable <= self.picked_until - self.offset:
+            return
+        envelope = self.envelope / (self.envelope_max + np.finfo(float).tiny)
+        peaks = librosa.util.peak_pick(envelope, pre_max=self.pre_max, post_max=self.post_max,
+                                       pre_avg=self.pre_avg, post_avg=self.post_avg, delta=0.07, wait=self.wait)
+        peaks = peaks[(peaks + self.offset >= self.picked_until) & (peaks < usable)]
+        kept = []
+        for peak in peaks:
+            if peak + self.offset - self.last_onset > self.wait:
+                kept.append(peak)
+                self.last_onset = peak + self.offset
+        self.picked_until = self.offset + usable
+        if not kept:
+            return
+
+        kept = np.array(kept)
+        backtracked = librosa.onset.onset_backtrack(kept, self.envelope)
+        pitches = estimate_onset_pitches(self.audio, self.sr, self.spec, kept, method=self.pitch_method,
+                                         window=self.pitch_window, hop_length=self.hop_length)
+        for frame, bt_frame, pitch in zip(kept, backtracked, pitches):
+            self.onsets.append({
+                "frame": frame + self.offset,
+                "time": self.frame_to_time(bt_frame + self.offset),
+                "pitch": pitch,
+                "loudness": self.loudness[frame],
+            })
+
+    def emit_notes(self, final):
+        '''Converts onsets to notes once the following onset is known (or right away in live mode).'''
+        if self.bpm is None:
+            return
+        sixteenth = TICKS_IN_BEAT / 4
+        for onset in self.onsets:
+            if "tick" not in onset:
+                tick = round(onset["time"] * TICKS_IN_BEAT / (60 / self.bpm) / sixteenth) * sixteenth
+                # handle overlapping
+                if self.last_tick is not None and tick <= self.last_tick:
+                    tick = self.last_tick + sixteenth
+                onset["tick"] = self.last_tick = tick
+                if self.live:
+                    onset["note"] = Note(self.onset_pitch(onset), tick, sixteenth, self.onset_velocity(onset))
+                    self.on_note(onset["note"])
+
+        end_tick = self.frame_to_time(self.n_frames) * TICKS_IN_BEAT / (60 / self.bpm)
+        n_ready = len(self.onsets) if final else len(self.onsets) - 1
+        for i in range(len(self.onsets) if self.live else n_ready):
+            onset = self.onsets[i]
+            next_tick = self.onsets[i + 1]["tick"] if i + 1 < len(self.onsets) else end_tick
+            duration = self.note_duration(onset, next_tick)
+            if self.live:
+                if duration != onset.get("duration", sixteenth):
+                    onset["duration"] = duration
+                    self.on_resize(onset["note"], duration)
+            elif i < n_ready:
+                self.on_note(Note(self.onset_pitch(onset), onset["tick"], duration, self.onset_velocity(onset)))
+        self.onsets = self.onsets[n_ready:]
+
+    def onset_pitch(self, onset):
+        return librosa.note_to_midi(librosa.hz_to_note(min(onset["pitch"], 20000)))
+
+    def onset_velocity(self, onset):
+        return min(127, int(onset["loudness"] * 127 / (self.loudness_max + np.finfo(float).tiny)))
+
+    def note_duration(self, onset, next_tick):
+        '''Duration of the note of `onset`, extended by 16th notes while it keeps sounding before `next_tick`.'''
+        sixteenth = TICKS_IN_BEAT / 4
+        duration = sixteenth
+        j = onset["tick"] + sixteenth * 3 / 2
+        while j < next_tick:
+            # check if the note continues, by looking at the loudness
+            frame = self.tick_to_frame(onset["tick"] + duration + sixteenth / 2) - self.offset
+            if 0 <= frame < len(self.loudness) and self.loudness[frame] > onset["loudness"] * 0.1:
+                duration += sixteenth
+            else:
+                break
+            j += sixteenth
+        return duration
+
+    def trim(self):
+        '''Drops frames that are no longer needed, keeping memory use flat.'''
+        keep_from = self.picked_until - self.pre_avg - self.pre_max - self.wait - 1
+        if self.onsets:
+            keep_from = min(keep_from, self.onsets[0]["frame"])
+        drop = keep_from - self.offset
+        if drop <= 0:
+            return
+        self.audio = self.audio[drop * self.hop_length:]
+        self.spec = self.spec[:, drop:]
+        self.loudness = self.loudness[drop:]
+        self.envelope = self.envelope[drop:]
+        self.offset += drop
+
+
+def read_librosa_stream(filename, piano_roll: PianoRoll, block_length=256, pitch_method="piptrack", progress=None):
+    '''
+    Transcribes `filename` block by block with StreamTranscriber, adding notes to `piano_roll` as they are found.
+    '''
+    sr = librosa.get_samplerate(filename)
+    n_fft = stream_frame_length(sr)
+    hop_length = n_fft // 4
+    stream = librosa.stream(filename, block_length=block_length, frame_length=n_fft, hop_length=hop_length,
+                            fill_value=0)
+
+    def add_note(note):
+        piano_roll.bpm = transcriber.bpm
+        piano_roll.add_note(note)
+
+    transcriber = StreamTranscriber(sr, add_note, n_fft=n_fft, hop_length=hop_length, pitch_method=pitch_method)
+    n_blocks = max(1, librosa.get_duration(path=filename) * sr / hop_length / block_length)
+    for i, block in enumerate(stream):
+        report_progress(progress, min(i / n_blocks, 1), "transcribing")
+        transcriber.push(block)
+    transcriber.finish()
+    print("Done!")
+
+
+MT3_SAMPLE_RATE = 16000     # sample rate of the MT3 spectrograms
+MT3_UPLOAD_FORMATS = {"WAV": "audio/wav", "FLAC": "audio/flac"}
+
+
+def encode_pcm16(y, sr, audio_format="WAV"):
+    '''Encodes mono float audio as 16-bit WAV or FLAC bytes, in memory.'''
+    buffer = io.BytesIO()
+    soundfile.write(buffer, y, sr, format=audio_format, subtype="PCM_16")
+    return buffer.getvalue()
+
+
+def read_mt3(filename, piano_roll: PianoRoll, upload_format="WAV", progress=None, raise_errors=False):
+    '''
+    Transcribes `filename` with the MT3 model of the mustrans server. If the server cannot be reached, the error is
+    printed and no notes are added, or it is raised if `raise_errors` (batch transcription).
+    '''
+    key = TRANSCRIPTION_CACHE.key(file_digest(filename), "mt3")
+    if add_cached_notes(piano_roll, key):
+        return
+
+    # decode, downmix and resample once, straight to the input format of the model
+    report_progress(progress, 0.0, "decoding")
+    y, sr = librosa.load(filename, sr=MT3_SAMPLE_RATE, mono=True)
+
+    # track bpm on the same buffer
+    report_progress(progress, 0.2, "tempo")
     bpm, beats = librosa.beat.beat_track(y=y, sr=sr)
-    bpm = int(round(bpm))
+    bpm = int(round(float(np.atleast_1d(bpm)[0])))
     piano_roll.bpm = bpm
 
+    # upload 16-bit mono PCM instead of the original file
+    audio_data = encode_pcm16(y, sr, upload_format)
     headers = {
-        "Accept": "application/json",
+        "Accept": f"{NOTES_MEDIA_TYPE}, application/json;q=0.9",
     }
     params = {
         "sample_rate": sr,
     }
-    with open(filename, "rb") as audio_file:
-        files = {
-            "audio_file": (Path(filename).name, audio_file, mimetypes.guess_type(filename)[0]),
-        }
-        
-        try:
-            response = requests.request(
-                "POST",
-                f"http://localhost:8200/music_transcription_with_transformers/mt3",
-                params=params,
-                headers=headers,
-                files=files,
-            ).json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error connecting to API: {e}")
-            return
-    
-    for note in response:
-        note["note"] = int(note["note"])
-        note["start_time"] = note["start_time"] * TICKS_IN_BEAT / (60 / bpm)
-        note["duration"] = note["duration"] * TICKS_IN_BEAT / (60 / bpm)
-        note["velocity"] = int(note["velocity"])
+    files = {
+        "audio_file": (f"{Path(filename).stem}.{upload_format.lower()}", audio_data, MT3_UPLOAD_FORMATS[upload_format]),
+    }
 
-        piano_roll.add_note(Note(note["note"], note["start_time"], note["duration"], note["velocity"]))
+    report_progress(progress, 0.3, "transcribing with MT3")
+    try:
+        response = decode_notes(MUSTRANS.post(
+            "/music_transcription_with_transformers/mt3",
+            params=params,
+            headers=headers,
+            files=files,
+        ))
+    except requests.exceptions.RequestException as e:
+        if raise_errors:
+            raise
+        print(f"Error connecting to API: {e}")
+        return
+    
+    to_tick = TICKS_IN_BEAT / (60 / bpm)
+    notes = {
+        "pitch": response["note"].astype(np.int16),
+        "start": response["start_time"] * to_tick,
+        "duration": response["duration"] * to_tick,
+        "velocity": response["velocity"].astype(np.int16),
+    }
+    TRANSCRIPTION_CACHE.put(key, bpm=bpm, **notes)
+    add_note_arrays(piano_roll, notes)
     # print(response)
 
 class Inputs():
@@ -178,60 +728,61 @@ class Inputs():
         self.midi_button = Button("MIDI", (SCREEN_WIDTH / 10 , ROLL_UP_BOUND / 2))
         self.librosa_button = Button("Librosa", (SCREEN_WIDTH / 4 , ROLL_UP_BOUND / 2))
         self.mt3_button = Button("Transformer",  (SCREEN_WIDTH * 3 / 7 , ROLL_UP_BOUND / 2))
+        self.poly_button = Button("Polyphonic", (SCREEN_WIDTH * 3 / 5 , ROLL_UP_BOUND / 2))
 
         self.record_button = Button("Record", (SCREEN_WIDTH * 9 / 10 , ROLL_UP_BOUND / 2))        
         self.recording = False
-
-
-    def record_audio(self):
-        CHUNK = 1024
-        FORMAT = pyaudio.paInt16
-        CHANNELS = 1
-        RATE = 44100
-        p = pyaudio.PyAudio()
-        stream = p.open(format=FORMAT,
-                    channels=CHANNELS,
-                    rate=RATE,
-                    input=True,
-                    frames_per_buffer=CHUNK)
-        
-        wf = wave.open("inputs/recording.wav", 'wb')
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(RATE)
-
+        self.recorder = None
+
+        self.imports = ImportQueue(piano_roll)
+        self.cancel_button = Button("Cancel", (SCREEN_WIDTH * 3 / 4 , ROLL_UP_BOUND / 2))
+        self.status_font = pygame.font.Font(None, 18)
+
+
+    def start_recording(self):
+        '''Records from the microphone and transcribes the sound onto the piano roll while recording.'''
+        source = MicrophoneSource(sr=ANALYSIS_SR)
+        n_fft = stream_frame_length(source.sr)
+        transcriber = StreamTranscriber(source.sr, self.piano_roll.post_note, bpm=self.piano_roll.bpm, n_fft=n_fft,
+                                        hop_length=n_fft // 4, post_avg_seconds=0.05, live=True,
+                                        on_resize=self.piano_roll.post_resize)
+        self.recorder = LiveRecorder(source, transcriber, wav_path=RECORDING_PATH)
+        self.recorder.start()
         print("* recording")
-        while self.recording:
-            data = stream.read(CHUNK)
-            wf.writeframes(data)
 
+
+    def stop_recording(self):
+        self.recorder.stop()
+        self.recorder = None
         print("* done recording")
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-        wf.close()
 
-        read_librosa("inputs/recording.wav", self.piano_roll)
+
+    def import_librosa(self, filename):
+        '''Transcribes an audio file with Librosa, streaming long WAV files onto the piano roll as they are read.'''
+        if filename.endswith(".wav") and librosa.get_duration(path=filename) > STREAM_MIN_DURATION:
+            self.imports.submit(read_librosa_stream, filename, incremental=True)
+        else:
+            self.imports.submit(read_librosa, filename)
 
 
     def handle_mouse(self, mouse_pos, event):
         midi_flag = self.midi_button.handle_mouse(mouse_pos, event)
         librosa_flag = self.librosa_button.handle_mouse(mouse_pos, event)
         mt3_flag = self.mt3_button.handle_mouse(mouse_pos, event)
+        poly_flag = self.poly_button.handle_mouse(mouse_pos, event)
 
-        if midi_flag or librosa_flag or mt3_flag:
+        if midi_flag or librosa_flag or mt3_flag or poly_flag:
             if platform.system() == "Windows":
                 tkinter.Tk().withdraw()
                 filename = askopenfilename()
                 if midi_flag and filename.endswith(".mid"):
-                    self.piano_roll.clear_notes()
-                    read_midi(filename, self.piano_roll)
+                    self.imports.submit(read_midi, filename)
                 elif librosa_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
-                    self.piano_roll.clear_notes()
-                    read_librosa(filename, self.piano_roll)
+                    self.import_librosa(filename)
                 elif mt3_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
-                    self.piano_roll.clear_notes()
-                    read_mt3(filename, self.piano_roll)
+                    self.imports.submit(read_mt3, filename)
+                elif poly_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
+                    self.imports.submit(read_librosa_poly, filename)
                 else:
                     print("Not valid file!")
 
@@ -242,18 +793,19 @@ class Inputs():
                         filename = os.path.join(dir_path, filename)
                         
                         if midi_flag and filename.endswith(".mid"):
-                            self.piano_roll.clear_notes()
-                            read_midi(filename, self.piano_roll)
+                            self.imports.submit(read_midi, filename)
                             file_found = True
                             break
                         elif librosa_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
-                            self.piano_roll.clear_notes()
-                            read_librosa(filename, self.piano_roll)
+                            self.import_librosa(filename)
                             file_found = True
                             break
                         elif mt3_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
-                            self.piano_roll.clear_notes()
-                            read_mt3(filename, self.piano_roll)
+                            self.imports.submit(read_mt3, filename)
+                            file_found = True
+                            break
+                        elif poly_flag and (filename.endswith(".wav") or filename.endswith(".mp3")):
+                            self.imports.submit(read_librosa_poly, filename)
                             file_found = True
                             break
                     if file_found:
@@ -266,16 +818,33 @@ class Inputs():
             self.record_button.change_text("Stop Recording")
             self.recording = True
             self.piano_roll.clear_notes()
-            threading.Thread(target=self.record_audio).start()
+            self.start_recording()
         elif self.record_button.handle_mouse(mouse_pos, event) and self.recording == True:
             self.record_button.change_text("Record")
             self.recording = False
+            self.stop_recording()
+
+
+        if self.imports.busy() and self.cancel_button.handle_mouse(mouse_pos, event):
+            self.imports.cancel()
                             
 
+    def draw_status(self):
+        '''Shows the progress of the running import, or the result of the last one.'''
+        status_surface = self.status_font.render(self.imports.status_text(), True, WHITE)
+        status_rect = status_surface.get_rect(midleft=(10, ROLL_UP_BOUND - 12))
+        SCREEN.blit(status_surface, status_rect)
+
+
     def update(self):
+        self.imports.poll()
         self.midi_button.draw_button()
         self.librosa_button.draw_button()
         self.mt3_button.draw_button()
+        self.poly_button.draw_button()
         self.record_button.draw_button()
+        if self.imports.busy():
+            self.cancel_button.draw_button()
+        self.draw_status()
 
 
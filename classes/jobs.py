@@ -0,0 +1,297 @@
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from classes.pianoroll import PianoRoll
+
+
+class JobCancelled(Exception):
+    '''Raised inside the work of a job (e.g. at its next progress report) once the job has been cancelled.'''
+
+
+class NoteCollector():
+    '''
+    Stands in for PianoRoll while importing off the main thread or without the GUI (transcribe.py): only keeps the
+    notes and the BPM.
+    '''
+    def __init__(self):
+        self.notes = []
+        self.bpm = None
+
+    def add_note(self, note):
+        self.notes.append(note)
+
+    def add_notes(self, notes):
+        self.notes.extend(notes)
+
+
+class BackgroundJob():
+    '''
+    Runs `work()` once on a daemon worker thread, keeping its result or error and how long it took.
+
+    Subclasses implement `work()`. Cancelling only sets a flag: work that can stop early raises JobCancelled when it
+    sees it, otherwise the caller ignores the result.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def done(self):
+        return self.end_time is not None
+
+    def elapsed(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def cancel(self):
+        self.cancelled = True
+
+    def work(self):
+        raise NotImplementedError
+
+    def report_error(self, e):
+        print(f"Error in {self.name}: {e}")
+
+    def run(self):
+        try:
+            self.result = self.work()
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+            self.report_error(e)
+        self.end_time = time.perf_counter()
+
+
+class ImportJob(BackgroundJob):
+    '''
+    Runs one importer (e.g. read_librosa) on a worker thread, writing into a NoteCollector.
+
+    The importer is called as `importer(filename, collector, progress=job.progress)` and may report its progress with
+    `progress(fraction, stage)`, which is also where cancellation takes effect.
+    '''
+    def __init__(self, importer, filename, incremental=False):
+        super().__init__(Path(filename).name)
+        self.importer = importer
+        self.filename = filename
+        self.incremental = incremental  # hand notes over while importing instead of once finished
+        self.collector = NoteCollector()
+        self.committed = 0              # number of collected notes already added to the piano roll
+
+        self.fraction = None
+        self.stage = "starting"
+
+    def progress(self, fraction=None, stage=None):
+        if self.cancelled:
+            raise JobCancelled()
+        if fraction is not None:
+            self.fraction = fraction
+        if stage is not None:
+            self.stage = stage
+
+    def work(self):
+        self.importer(self.filename, self.collector, progress=self.progress)
+
+    def report_error(self, e):
+        print(f"Error importing {self.filename}: {e}")
+
+    def status_text(self):
+        if self.done():
+            if self.error is not None:
+                return f"{self.name}: failed ({self.error})"
+            return f"{self.name}: {len(self.collector.notes)} notes in {self.elapsed():.1f} s"
+        percent = f" {int(self.fraction * 100)}%" if self.fraction is not None else ""
+        return f"{self.name}: {self.stage}{percent} ({self.elapsed():.1f} s)"
+
+
+class ImportQueue():
+    '''
+    Runs import jobs one at a time off the main thread, so the window keeps repainting while importing.
+
+    `poll` must be called on the main thread once per frame: it is the only place where imported notes are added to
+    the piano roll, all at once when a job finishes (or batch by batch for incremental jobs).
+    '''
+    def __init__(self, piano_roll: PianoRoll):
+        self.piano_roll = piano_roll
+        self.job: ImportJob = None
+        self.message = ""               # status of the last finished job
+
+    def submit(self, importer, filename, incremental=False):
+        self.cancel()
+        self.job = ImportJob(importer, filename, incremental)
+        self.job.start()
+
+    def busy(self):
+        return self.job is not None
+
+    def cancel(self):
+        '''Cancels the running job. Notes it has not committed yet are discarded.'''
+        if self.job is not None:
+            self.job.cancel()
+            self.message = f"{self.job.name}: cancelled"
+            self.job = None
+
+    def poll(self):
+        job = self.job
+        if job is None:
+            return
+        done = job.done()
+        if job.error is None and (done or job.incremental):
+            self.commit(job, done)
+        if done:
+            self.message = job.status_text()
+            self.job = None
+
+    def commit(self, job: ImportJob, done):
+        notes = job.collector.notes[job.committed:]
+        if not notes and (job.committed > 0 or not done):
+            return
+        if job.collector.bpm is not None:
+            self.piano_roll.bpm = job.collector.bpm
+        # the first batch replaces the current notes in the same commit
+        self.piano_roll.add_notes(notes, clear=job.committed == 0)
+        job.committed += len(notes)
+
+    def status_text(self):
+        return self.job.status_text() if self.job is not None else self.message
+
+
+class GenerationJob(BackgroundJob):
+    '''
+    Runs one generation request (e.g. to the musgen server) on a worker thread.
+
+    `generate()` returns the generated notes. The job keeps the version of the note store the request was built
+    from, so that a result arriving after the piano roll was edited can be recognised as stale and dropped.
+    Cancelling cannot interrupt the request, its result is ignored instead.
+    '''
+    def __init__(self, generate, name, version):
+        super().__init__(name)
+        self.generate = generate
+        self.version = version
+
+    def work(self):
+        return self.generate()
+
+    def report_error(self, e):
+        print(f"Error generating with {self.name}: {e}")
+
+    def status_text(self):
+        if not self.done():
+            return f"{self.name}: generating ({self.elapsed():.1f} s)"
+        if self.error is not None:
+            return f"{self.name}: failed"
+        return f"{self.name}: {len(self.result)} notes in {self.elapsed():.1f} s"
+
+
+class Speculator():
+    '''
+    Requests continuations in the background before Generate is pressed, and keeps them by request key.
+
+    A request key identifies everything the result depends on (notes, tempo, model, duration, temperature). Once
+    the key has stayed the same for `idle_ms`, the continuation for it is requested, so that pressing Generate can
+    usually use a finished result. At most `max_jobs` requests run at once, including cancelled ones still waiting
+    for the server, and requests for an outdated key are cancelled as soon as the key changes. A key whose request
+    failed is not requested again (the server is down or cannot continue these notes); pressing Generate still can.
+    '''
+    def __init__(self, idle_ms, max_jobs=1, max_results=16):
+        self.idle_ms = idle_ms
+        self.max_jobs = max_jobs
+        self.max_results = max_results
+        self.key = None
+        self.key_time = 0
+        self.jobs = {}                  # key -> running GenerationJob
+        self.cancelled = []             # cancelled jobs, counted until the server answers
+        self.results = OrderedDict()    # key -> generated notes, least recently added first
+        self.failed = set()             # keys whose request failed
+
+    def update(self, key, now, start_job):
+        '''
+        Called once per frame with the current request key and time (ms). `start_job()` builds and starts the
+        GenerationJob for the current key.
+        '''
+        if key != self.key:
+            self.key = key
+            self.key_time = now
+            for job_key in [job_key for job_key in self.jobs if job_key != key]:
+                job = self.jobs.pop(job_key)
+                job.cancel()
+                self.cancelled.append(job)
+        self.cancelled = [job for job in self.cancelled if not job.done()]
+
+        for job_key, job in list(self.jobs.items()):
+            if job.done():
+                del self.jobs[job_key]
+                if job.error is None:
+                    self.results[job_key] = job.result
+                    while len(self.results) > self.max_results:
+                        self.results.popitem(last=False)
+                else:
+                    self.failed.add(job_key)
+
+        idle = now - self.key_time >= self.idle_ms
+        running = len(self.jobs) + len(self.cancelled)
+        known = key in self.results or key in self.jobs or key in self.failed
+        if idle and key is not None and not known and running < self.max_jobs:
+            self.jobs[key] = start_job()
+
+    def take(self, key):
+        '''
+        Hands over what was speculated for `key`: the generated notes if finished, else the running GenerationJob,
+        else None. Either way it is removed, so the next Generate asks for a new continuation.
+        '''
+        if key in self.results:
+            return self.results.pop(key)
+        return self.jobs.pop(key, None)
+
+
+class FanOut():
+    '''
+    Runs one GenerationJob per model at the same time and collects the finished ones as candidates, in the order
+    they complete. Jobs still running after `budget` seconds are cancelled, so the whole fan-out takes about as long
+    as its slowest model within the budget.
+    '''
+    def __init__(self, jobs, version, budget):
+        self.jobs = list(jobs)
+        self.version = version
+        self.budget = budget
+        self.start_time = time.perf_counter()
+        self.candidates = []            # finished GenerationJobs with a result
+        self.failed = 0
+        self.finished = False
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def poll(self):
+        '''Returns the jobs that finished since the last poll.'''
+        finished = []
+        running = []
+        for job in self.jobs:
+            (finished if job.done() else running).append(job)
+        self.jobs = running
+        new = [job for job in finished if job.error is None]
+        self.failed += len(finished) - len(new)
+        self.candidates.extend(new)
+        if self.jobs and self.elapsed() > self.budget:
+            self.cancel()
+        self.finished = not self.jobs
+        return new
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+        self.failed += len(self.jobs)
+        self.jobs = []
+
+    def status_text(self):
+        total = len(self.candidates) + self.failed + len(self.jobs)
+        state = "generating" if self.jobs else "done"
+        return f"all models: {state}, {len(self.candidates)}/{total} candidates ({self.elapsed():.1f} s)"
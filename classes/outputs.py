@@ -1,121 +1,212 @@
 import datetime
-import json
-import mimetypes
+import hashlib
+import io
 import os
 import platform
-import threading
 import tkinter as tk
-from pathlib import Path
 from tkinter import filedialog
 
+import mido
 import numpy as np
-import pretty_midi
 import pygame
 import requests
 from pydub import AudioSegment
 from scipy.io import wavfile
 
 import classes.markov as markov
+import classes.synth as synth
+from classes.api_client import (MUSGEN, PCM_STREAM_MEDIA_TYPE, WAV_MEDIA_TYPE, note_dicts_to_array, read_pcm_stream,
+                                write_wav_response)
+from classes.audio_stream import AudioStream
 from classes.constants import *
-from classes.inputs import read_midi
-from classes.pianoroll import PianoRoll
+from classes.jobs import FanOut, GenerationJob, Speculator
+from classes.pianoroll import Note, PianoRoll
+from classes.transport import PlaybackTransport
 from classes.ui_elements import Button
 
-GANSYNTH_INPUT_PATH = "synthesis/input/input.mid"
+GANSYNTH_PITCH_RANGE = (24, 84)
 GANSYNTH_OUTPUT_PATH = "synthesis/output/output.wav"
 GANSYNTH_OUTPUT_MP3_PATH = "synthesis/output/output.mp3"
-TEMP_MIDI_FILE = "temp.mid"
-GEN_MIDI_FILE = "gen.mid"
-LAST_GEN_MIDI_FILE_PATH = os.path.join(TEMP_MUSIC_DIRECTORY, GEN_MIDI_FILE)
 MACOS_EXPORT_FOLDER = "export"
 
 if not os.path.exists(TEMP_MUSIC_DIRECTORY):
     os.makedirs(TEMP_MUSIC_DIRECTORY)
-if not os.path.exists("synthesis/input"):
-    os.makedirs("synthesis/input")
 if not os.path.exists("synthesis/output"):
     os.makedirs("synthesis/output")
 if not os.path.exists(MACOS_EXPORT_FOLDER):
     os.makedirs(MACOS_EXPORT_FOLDER)
 
-def gansynth(midi_path, seconds_per_instrument):
-    """connected to api."""
+def notes_to_midi(notes, bpm, start_tick=0, pitch_range=None):
+    """
+    Serialize notes to an in-memory MIDI file.
+
+    The file uses the piano roll's own resolution (TICKS_IN_BEAT per beat) and tempo, so note ticks are written as
+    they are, without a round trip through seconds.
+
+    Args:
+        notes (Sequence[Note]): Notes to write
+        bpm (int): Tempo of the piano roll
+        start_tick (int): Notes before this tick are dropped and the file starts here
+        pitch_range (Tuple[int, int]): If given, pitches are clamped to this range
+
+    Returns:
+        io.BytesIO: The MIDI file, rewound to the start
+    """
+    pitch = np.array([note.pitch for note in notes], dtype=int)
+    start = np.array([note.start for note in notes], dtype=float)
+    end = np.array([note.end for note in notes], dtype=float)
+    velocity = np.array([note.velocity for note in notes], dtype=int)
+
+    keep = end > start_tick
+    pitch, start, end, velocity = pitch[keep], start[keep], end[keep], velocity[keep]
+    if pitch_range is not None:
+        pitch = np.clip(pitch, *pitch_range)
+    start = np.round(np.maximum(start - start_tick, 0)).astype(int)
+    end = np.maximum(np.round(end - start_tick).astype(int), start)
+
+    # note offs sort before note ons at the same tick, so repeated pitches are not cut short
+    times = np.concatenate([start, end])
+    is_on = np.concatenate([np.ones(len(start), dtype=bool), np.zeros(len(end), dtype=bool)])
+    pitches = np.concatenate([pitch, pitch])
+    velocities = np.concatenate([velocity, np.zeros(len(end), dtype=int)])
+    order = np.lexsort((is_on, times))
+    deltas = np.diff(times[order], prepend=0)
+
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(bpm), time=0))
+    track.append(mido.Message("program_change", program=0, time=0))
+    for i, delta in zip(order, deltas):
+        message_type = "note_on" if is_on[i] else "note_off"
+        track.append(mido.Message(message_type, note=int(pitches[i]), velocity=int(velocities[i]), time=int(delta)))
+
+    midi_file = mido.MidiFile(ticks_per_beat=TICKS_IN_BEAT)
+    midi_file.tracks.append(track)
+    buffer = io.BytesIO()
+    midi_file.save(file=buffer)
+    buffer.seek(0)
+    buffer.name = "notes.mid"
+    return buffer
+
+
+def generated_to_notes(note_dicts, bpm):
+    """
+    Convert notes returned by a generation model (in seconds) to piano roll notes (in ticks).
+
+    Starts are rounded and durations rounded up to a sixteenth note, like imported MIDI files.
+
+    Args:
+        note_dicts (Union[List[Dict[str, float]], np.ndarray]): Notes with "note", "start_time", "duration" and
+            "velocity" keys, or a NOTE_DTYPE array with the same fields
+        bpm (int): Tempo of the piano roll
+
+    Returns:
+        List[Note]: The notes, in the order they were given
+    """
+    if not isinstance(note_dicts, np.ndarray):
+        note_dicts = note_dicts_to_array(note_dicts)
+    to_tick = TICKS_IN_BEAT * bpm / 60
+    smallest_time = TICKS_IN_BEAT // 4
+    start = np.round(note_dicts['start_time'] * to_tick / smallest_time).astype(int) * smallest_time
+    duration = np.maximum(np.ceil(note_dicts['duration'] * to_tick / smallest_time), 1).astype(int) * smallest_time
+    return [
+        Note(int(pitch), int(note_start), int(note_duration), int(velocity))
+        for pitch, note_start, note_duration, velocity
+        in zip(note_dicts['note'], start, duration, note_dicts['velocity'])
+    ]
+
+
+def context_notes(note_dicts, qpm, context_seconds):
+    """
+    Notes sounding in the last `context_seconds` (from the start of that beat), which is all the musgen models are
+    primed with when given the same `context_seconds`. Returns all notes if `context_seconds` is None.
+    """
+    if context_seconds is None or not note_dicts:
+        return note_dicts
+    last_end_time = max(note['start_time'] + note['duration'] for note in note_dicts)
+    beat = 60 / qpm
+    context_start = max((last_end_time - context_seconds) // beat * beat, 0.0)
+    return [note for note in note_dicts if note['start_time'] + note['duration'] > context_start]
+
+
+def generation_key(notes, bpm, model_name, extend_duration, temperature):
+    """hash of everything a generated continuation depends on"""
+    digest = hashlib.sha1()
+    digest.update(repr((bpm, model_name, extend_duration, temperature)).encode())
+    for note in notes:
+        digest.update(repr((note.pitch, note.start, note.duration, note.velocity)).encode())
+    return digest.hexdigest()
+
+
+def gansynth(midi_file, seconds_per_instrument, on_block=None):
+    """
+    connected to api. `midi_file` is a file object, e.g. from notes_to_midi.
+    `on_block(audio, sample_rate)` is called with the audio as the server streams it, or once with all of it if the
+    server does not stream
+    """
     print(f'seconds per instruments: {seconds_per_instrument}')
     headers = {
-        "Accept": "application/json",
+        "Accept": f"{PCM_STREAM_MEDIA_TYPE}, {WAV_MEDIA_TYPE};q=0.9, application/json;q=0.8",
     }
     params = {
         "seconds_per_instrument": seconds_per_instrument,
         "sample_rate": 16000,
     }
 
-    with open(midi_path, "rb") as midi_file:
-        files = {
-            "midi_file": (Path(midi_path).name, midi_file, mimetypes.guess_type(midi_path)[0]),
-        }
-        response = requests.request(
-            "POST",
-            "http://localhost:8100/gansynth",
-            params=params,
-            headers=headers,
-            files=files,
-        ).json()
-
-    print('ready to create .wav')
+    files = {
+        "midi_file": ("input.mid", midi_file, "audio/midi"),
+    }
+    response = MUSGEN.post(
+        "/gansynth",
+        params=params,
+        headers=headers,
+        files=files,
+        stream=True,
+    )
 
     def save_wav(audio, fname, sr=16000):
         wavfile.write(fname, sr, audio.astype('float32'))
-        print('Saved to {}'.format(fname))
 
-    save_wav(np.array(response), GANSYNTH_OUTPUT_PATH)
+    streamed = read_pcm_stream(response, on_block)
+    print('ready to create .wav')
+    if streamed is not None:
+        # the stream is scaled by a bound on its peak, so normalize it like the non-streamed answer for Play
+        audio, sample_rate = streamed
+        peak = np.abs(audio).max() if len(audio) else 0.0
+        if peak > 0:
+            audio = audio * (0.5 / peak)
+        save_wav(audio, GANSYNTH_OUTPUT_PATH, sample_rate)
+    else:
+        if not write_wav_response(response, GANSYNTH_OUTPUT_PATH):
+            save_wav(np.array(response.json()), GANSYNTH_OUTPUT_PATH)
+        if on_block is not None:
+            sample_rate, audio = wavfile.read(GANSYNTH_OUTPUT_PATH)
+            on_block(audio, sample_rate)
+    print('Saved to {}'.format(GANSYNTH_OUTPUT_PATH))
     AudioSegment.from_wav(GANSYNTH_OUTPUT_PATH).export(GANSYNTH_OUTPUT_MP3_PATH, format="mp3")
 
 
-def midi2wav_api(input_midi, output_wav):
+def midi2wav_api(midi_file, output_wav):
+    """`midi_file` is a file object, e.g. from notes_to_midi"""
     def save_wav(audio: np.array, file_name, sample_rate: int = 44100):
         wavfile.write(file_name, sample_rate, audio)
 
-    with open(input_midi, "rb") as midi_file:
-        try:
-            response = requests.request(
-                "POST",
-                "http://localhost:8100/midi2wav",
-                headers={
-                    "Accept": "application/json",
-                },
-                files={
-                    "midi_file": (Path(input_midi).name, midi_file, mimetypes.guess_type(input_midi)[0]),
-                },
-            ).json()
-        except requests.exceptions.RequestException as e:
-            print(f"Error connecting to midi2wav API: {e}")
-            return
-
-    save_wav(np.array(response["audio"], dtype=response["dtype"]), output_wav, sample_rate=response["sample_rate"])
-
-def play_music(path, piano_roll: PianoRoll, output_obj=None):
-    '''play midi or mp3'''
-    if not os.path.exists(path):
-        print(f"Error: File {path} not found.")
-        return None
-
-    #pygame.init()
-    music = pygame.mixer.music
-    output_obj.generated_music_channel = music
-    playhead_start_tick = piano_roll.playhead_pos
-    ticks_from_start = playhead_start_tick
-    tick_duration = 60000/(piano_roll.bpm * TICKS_IN_BEAT) #in ms
-    playhead_start_time = playhead_start_tick * tick_duration if path == GANSYNTH_OUTPUT_MP3_PATH else 0
     try:
-        music.load(path) # returns None
-        music.play(start=playhead_start_time/1000)
-        while (music.get_busy()):
-            ticks_from_start = playhead_start_tick + int(music.get_pos() / tick_duration)
-            if (ticks_from_start > playhead_start_tick):
-                piano_roll.set_playhead_tick(ticks_from_start)
-    except pygame.error as e:
-        print(e)
-    return music    
+        response = MUSGEN.post(
+            "/midi2wav",
+            headers={
+                "Accept": f"{WAV_MEDIA_TYPE}, application/json;q=0.9",
+            },
+            files={
+                "midi_file": ("input.mid", midi_file, "audio/midi"),
+            },
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Error connecting to midi2wav API: {e}")
+        return
+
+    if not write_wav_response(response, output_wav):
+        response = response.json()
+        save_wav(np.array(response["audio"], dtype=response["dtype"]), output_wav, sample_rate=response["sample_rate"])
 
 class DurationSlider():
     """music extension duration"""
@@ -244,6 +335,56 @@ class ModelOptions():
             self.model_num = (self.model_num + 1) % self.models_len
         
 
+class CandidateOptions():
+    """browse the continuations of Generate All"""
+    def __init__(self):
+        self.width = 300
+        self.height = 30
+        self.image = pygame.Surface((self.width, self.height))
+        self.rect = self.image.get_rect(topleft=(750, OUTPUTS_HEIGHT - 80))
+        self.font = pygame.font.Font(None, 18)
+        self.margin = 30
+        self.left_arrow = Button('<', (self.margin, self.rect.height//2))
+        self.right_arrow = Button('>', (self.width-self.margin, self.rect.height//2))
+        self.candidates = []    # finished GenerationJobs
+        self.candidate_num = 0
+
+    def add(self, jobs):
+        self.candidates.extend(jobs)
+
+    def clear(self):
+        self.candidates = []
+        self.candidate_num = 0
+
+    def get_candidate(self):
+        if not self.candidates:
+            return None
+        return self.candidates[self.candidate_num]
+
+    def draw(self, surface):
+        if not self.candidates:
+            return
+        self.image.fill(BLACK)
+        self.image.blit(self.left_arrow.surface, self.left_arrow.rect)
+        self.image.blit(self.right_arrow.surface, self.right_arrow.rect)
+        job = self.get_candidate()
+        candidate_text = f"{self.candidate_num + 1}/{len(self.candidates)} {job.name} ({job.elapsed():.1f} s)"
+        text_surface = self.font.render(candidate_text, True, WHITE)
+        text_rect = text_surface.get_rect(center=(self.width // 2, self.height // 2))
+        self.image.blit(text_surface, text_rect)
+        surface.blit(self.image, self.rect)
+        return
+
+    def handle_mouse(self, pos, event):
+        if not self.candidates:
+            return
+        pos = (pos[0] - self.rect.left, pos[1] - self.rect.top)
+        if self.left_arrow.handle_mouse(pos, event):
+            self.candidate_num = (self.candidate_num - 1) % len(self.candidates)
+        elif self.right_arrow.handle_mouse(pos, event):
+            self.candidate_num = (self.candidate_num + 1) % len(self.candidates)
+
+
 class Output():
     """bottom row buttons"""
     def __init__(self, piano_roll):
@@ -258,6 +399,11 @@ class Output():
         self.add_to_piano_roll_button = Button("Update", (270, OUTPUTS_HEIGHT - 25))
         self.gansynth_button = Button("GANSynth", (380, OUTPUTS_HEIGHT - 25))
         self.play_button = Button("Play", (470, OUTPUTS_HEIGHT - 25))
+        self.pause_button = Button("Pause", (550, OUTPUTS_HEIGHT - 25))
+        self.loop_button = Button("Loop: Off", (640, OUTPUTS_HEIGHT - 25))
+        self.generate_all_button = Button("Generate All", (750, OUTPUTS_HEIGHT - 25))
+        self.preview_candidate_button = Button("Preview", (840, OUTPUTS_HEIGHT - 25))
+        self.accept_candidate_button = Button("Accept", (910, OUTPUTS_HEIGHT - 25))
         self.export_wav_button = Button("Export WAV", (OUTPUTS_RIGHT_BOUND - 200, OUTPUTS_HEIGHT - 25))
         self.export_midi_button = Button("Export MIDI", (OUTPUTS_RIGHT_BOUND - 70, OUTPUTS_HEIGHT - 25))
         self.duration_slider = DurationSlider()
@@ -268,38 +414,55 @@ class Output():
         self.instrument_second = 2
 
         self.extend_options = ModelOptions()
-        self.generated_music_channel = None
-        self.generated_music_playing = False
-        self.music_thread = None
-
-
-    def piano_roll_to_midi(self, filepath, playhead_time = 0.0):
+        self.transport = PlaybackTransport(piano_roll)
+        self.generation: GenerationJob = None
+        self.generation_message = ""    # status of the last finished generation
+        self.fallback: GenerationJob = None     # local markov_chain job racing self.generation
+        self.fallback_notes = None      # fallback notes added to the piano roll while waiting for self.generation
+        self.fallback_version = None    # note store version right after adding them
+        self.temperature = 0.5
+        self.speculator = Speculator(SPECULATION_IDLE_MS, max_jobs=SPECULATION_MAX_JOBS)
+        self.request_state = None       # what the current request key was computed from
+        self.request_key = None
+        self.fanout: FanOut = None
+        self.candidate_options = CandidateOptions()
+        self.preview_notes = []         # candidate notes played with the piano roll by Preview
+        self.audio_stream: AudioStream = None   # GANSynth audio playing while it is downloaded
+        self.status_font = pygame.font.Font(None, 18)
+
+
+    def piano_roll_to_midi(self, start_tick=0, pitch_range=None, notes=None):
         """
-        convert notes in piano roll to midi, starting from playhead_time to end.
-        if playhead_time=0, that means converting the whole piano roll into midi.
+        convert notes in piano roll (or `notes`) to an in-memory midi file, starting from start_tick to end.
+        if start_tick=0, that means converting the whole piano roll into midi.
         """
-        midi_data = pretty_midi.PrettyMIDI()
-        instrument = pretty_midi.Instrument(program=0)
+        if notes is None:
+            notes = self.piano_roll.notes
+        return notes_to_midi(notes, self.piano_roll.bpm, start_tick, pitch_range)
 
+    def render_audio(self, start_tick=0, parallel=False, notes=None):
+        """
+        render notes in piano roll (or `notes`) from start_tick to end with the built-in synth, on all cores if
+        parallel. a process pool only pays off for exports: playback renders run on a worker thread of the GUI,
+        where forking (or spawning processes that import pygame again) costs more than it saves
+        """
+        if notes is None:
+            notes = self.piano_roll.notes
         to_realtime = 60/(TICKS_IN_BEAT*self.piano_roll.bpm)
-        for note_info in self.piano_roll.notes:
-            pitch = note_info.pitch  # Convert note to integer
-            if filepath == GANSYNTH_INPUT_PATH:
-                if pitch < 24:
-                    pitch = 24
-                elif pitch > 84:
-                    pitch = 84
-            start_time = to_realtime * note_info.start - playhead_time
-            end_time = to_realtime * note_info.end - playhead_time
-            velocity = note_info.velocity
-            if start_time < 0:
-                start_time = 0
-            if end_time > 0:
-                note = pretty_midi.Note(velocity=int(velocity), pitch=int(pitch), start=float(start_time), end=float(end_time))
-                instrument.notes.append(note)
-        
-        midi_data.instruments.append(instrument)
-        midi_data.write(filepath)
+        notes = [note for note in notes if note.end > start_tick]
+        render = synth.render_notes_parallel if parallel else synth.render_notes
+        return render(
+            pitch=[note.pitch for note in notes],
+            start=[to_realtime * max(note.start - start_tick, 0) for note in notes],
+            end=[to_realtime * (note.end - start_tick) for note in notes],
+            velocity=[note.velocity for note in notes],
+        )
+
+    def export_wav(self, path):
+        if RENDERER == "builtin":
+            synth.write_wav(self.render_audio(parallel=True), path)
+        else:
+            midi2wav_api(self.piano_roll_to_midi(), path)
 
     def export(self, file_extension):
         """export a midi/wav file"""
@@ -311,11 +474,10 @@ class Output():
                 self.export_folder, self.export_filename = os.path.split(export_path)
                 print(f"Exporting {self.export_filename} in {self.export_folder}")
                 if file_extension == "mid":
-                    self.piano_roll_to_midi(export_path)
+                    with open(export_path, "wb") as midi_file:
+                        midi_file.write(self.piano_roll_to_midi().getvalue())
                 elif file_extension == "wav":
-                    temp_midi_path = os.path.join(TEMP_MUSIC_DIRECTORY, TEMP_MIDI_FILE)
-                    self.piano_roll_to_midi(temp_midi_path)
-                    midi2wav_api(temp_midi_path, export_path)
+                    self.export_wav(export_path)
         else: # using macOS
             current_time = datetime.datetime.now()
             formatted_time = current_time.strftime("%Y%m%d_%H%M%S")
@@ -323,127 +485,277 @@ class Output():
             file_name = os.path.join(MACOS_EXPORT_FOLDER, file_name)
             if file_extension == "mid":
                 print(f"Exporting {file_name} in {MACOS_EXPORT_FOLDER}")
-                self.piano_roll_to_midi(file_name)
+                with open(file_name, "wb") as midi_file:
+                    midi_file.write(self.piano_roll_to_midi().getvalue())
             elif file_extension == "wav":
                 print(f"Exporting {file_name} in {MACOS_EXPORT_FOLDER}")
-                temp_midi_path = os.path.join(TEMP_MUSIC_DIRECTORY, TEMP_MIDI_FILE)
-                self.piano_roll_to_midi(temp_midi_path)
-                midi2wav_api(temp_midi_path, export_path)
-
-    def handle_generate_click(self):
-        """connected to api"""
-        if self.generated_music_playing and self.generated_music_channel is not None:
-            self.generated_music_channel.stop()
-            self.generated_music_playing = False
-
+                self.export_wav(file_name)
+
+    def current_request_key(self):
+        """request key of the current notes and settings, only rehashed when one of them changes"""
+        _, model_name = self.extend_options.get_model()
+        state = (self.piano_roll.store.version, self.piano_roll.bpm, model_name,
+                 self.duration_slider.extend_duration, self.temperature)
+        if state != self.request_state:
+            self.request_state = state
+            self.request_key = generation_key(self.piano_roll.notes, *state[1:])
+        return self.request_key
+
+    def start_generation(self, model=None, timeout=None):
+        """starts a GenerationJob for the current notes and settings, with `model` instead of the selected one if given"""
+        version, snapshot = self.piano_roll.store.versioned_snapshot()
         to_realtime = 60/(96*self.piano_roll.bpm)
         notes = [{'note': int(note.pitch),
                 'start_time': float(to_realtime * note.start),
                 'duration': float(to_realtime * note.duration),
-                'velocity': float(note.velocity)} for note in self.piano_roll.notes]
+                'velocity': float(note.velocity)} for note in snapshot]
 
         params = {
             "qpm": int(self.piano_roll.bpm),
             "extend_duration": self.duration_slider.extend_duration,
-            "temperature": 0.5,
+            "temperature": self.temperature,
         }
+        if GENERATION_CONTEXT_SECONDS is not None:
+            params["context_seconds"] = GENERATION_CONTEXT_SECONDS
+
+        model_type, model_name = model or self.extend_options.get_model()
+        request_options = {} if timeout is None else {"timeout": (API_CONNECT_TIMEOUT, timeout)}
+
+        def generate():
+            if model_name == 'markov_chain':
+                return markov.generate(
+                    notes=notes,
+                    tick=1/96,
+                    extend_duration=params['extend_duration'],
+                    variation=0.2,
+                )
+            return MUSGEN.post_notes(
+                f"/{model_type}/{model_name}",
+                context_notes(notes, params['qpm'], GENERATION_CONTEXT_SECONDS),
+                params=params,
+                **request_options,
+            )
 
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+        job = GenerationJob(generate, model_name, version)
+        job.start()
+        return job
 
-        model_type, model_name = self.extend_options.get_model()
+    def handle_generate_click(self):
+        """connected to api. runs in the background; clicking again while it runs cancels it"""
+        if self.generation is not None:
+            self.generation.cancel()
+            self.generation_message = f"{self.generation.name}: cancelled"
+            self.generation = None
+            if self.fallback is not None:
+                self.fallback.cancel()
+            self.fallback = None
+            self.fallback_notes = None
+            return
+        self.transport.stop()
+
+        speculated = self.speculator.take(self.current_request_key())
+        if isinstance(speculated, GenerationJob):
+            self.generation = speculated    # already requested in the background, wait for it
+        elif speculated is not None:
+            self.piano_roll.add_notes(generated_to_notes(speculated, self.piano_roll.bpm))
+            self.generation_message = f"{self.extend_options.get_model()[1]}: {len(speculated)} notes, pre-generated"
+            return
+        else:
+            self.generation = self.start_generation()
+        # hedge remote models with the local one, in case the server is slow or down
+        if self.extend_options.get_model()[1] != 'markov_chain':
+            self.fallback = self.start_generation(model=("custom", "markov_chain"))
+
+    def handle_generate_all_click(self):
+        """request a continuation from every model at once; clicking again while they run stops waiting for them"""
+        if self.fanout is not None and not self.fanout.finished:
+            self.fanout.cancel()
+            return
+        self.candidate_options.clear()
+        version = self.piano_roll.store.version
+        jobs = [self.start_generation(model, FANOUT_BUDGET_SECONDS) for model in self.extend_options.models]
+        self.fanout = FanOut(jobs, version, FANOUT_BUDGET_SECONDS)
 
-        if model_name == 'markov_chain':
-            response = markov.generate(
-                notes=notes,
-                tick=1/96,
-                extend_duration=params['extend_duration'],
-                variation=0.2,
-            )
+    def poll_fanout(self):
+        if self.fanout is None:
+            return
+        if self.piano_roll.store.version != self.fanout.version:
+            self.fanout.cancel()
+            self.fanout = None
+            self.candidate_options.clear()
+            self.generation_message = "all models: dropped, the piano roll was edited while generating"
+            return
+        self.candidate_options.add(self.fanout.poll())
+
+    def candidate_notes(self):
+        job = self.candidate_options.get_candidate()
+        if job is None:
+            return None
+        return generated_to_notes(job.result, self.piano_roll.bpm)
+
+    def prepare_candidate_playback(self, start_tick):
+        """the piano roll with the current candidate added, rendered like Quick Play"""
+        notes = list(self.piano_roll.notes) + self.preview_notes
+        if RENDERER == "builtin":
+            return synth.to_wav(self.render_audio(start_tick, notes=notes)), 0.0
+        return self.piano_roll_to_midi(start_tick, notes=notes), 0.0
+
+    def handle_preview_candidate_click(self):
+        if self.transport.is_playing("candidate"):
+            self.transport.stop()
+            return
+        self.preview_notes = self.candidate_notes()
+        if self.preview_notes is not None:
+            self.transport.play("candidate", self.prepare_candidate_playback, self.piano_roll.playhead_pos,
+                                background=True)
+
+    def handle_accept_candidate_click(self):
+        notes = self.candidate_notes()
+        if notes is None:
+            return
+        self.transport.stop()
+        self.generation_message = f"{self.candidate_options.get_candidate().name}: {len(notes)} notes accepted"
+        self.piano_roll.add_notes(notes)
+        self.fanout = None
+        self.candidate_options.clear()
+
+    def speculate(self):
+        """requests the continuation in the background once the notes and settings have been left alone for a while"""
+        _, model_name = self.extend_options.get_model()
+        if self.generation is not None or self.fanout is not None or model_name == 'markov_chain':
+            key = None                      # markov_chain is local and fast enough not to speculate
+        elif not self.piano_roll.notes:
+            key = None                      # nothing to continue
+        else:
+            key = self.current_request_key()
+        self.speculator.update(key, pygame.time.get_ticks(), self.start_generation)
+
+    def poll_generation(self):
+        """
+        adds the notes of a finished generation, unless the piano roll was edited since it was requested.
+        if the model is late or fails, the markov_chain fallback is added meanwhile and replaced when the model answers.
+        """
+        job = self.generation
+        if job is None:
+            return
+        fallback = self.fallback
+        if fallback is not None and self.fallback_notes is None:
+            failed = job.done() and job.error is not None
+            late = not job.done() and job.elapsed() >= GENERATION_BUDGET_SECONDS
+            if (failed or late) and not fallback.done():
+                return      # the fallback is local and about to finish
+            if (failed or late) and fallback.error is None:
+                self.add_fallback_notes(job, fallback)
+        if not job.done():
+            return
 
+        self.generation = None
+        fallback_notes = self.fallback_notes
+        self.fallback = None
+        self.fallback_notes = None
+        if job.error is not None:
+            if fallback_notes is None:
+                self.generation_message = job.status_text()
+        elif fallback_notes is not None:
+            if self.piano_roll.store.version != self.fallback_version:
+                self.generation_message = f"{job.name}: dropped, the piano roll was edited after the fallback was added"
+            else:
+                self.piano_roll.replace_notes(fallback_notes, generated_to_notes(job.result, self.piano_roll.bpm))
+                self.generation_message = f"{job.status_text()}, replaced the markov_chain fallback"
+        elif self.piano_roll.store.version != job.version:
+            self.generation_message = f"{job.name}: dropped, the piano roll was edited while generating"
         else:
-            try:
-                response = requests.request(
-                    "POST",
-                    f"http://localhost:8100/{model_type}/{model_name}",
-                    params=params,
-                    headers=headers,
-                    data=json.dumps(notes),
-                ).json()
-            except requests.exceptions.RequestException as e:
-                print(f"Error connecting to API: {e}")
-                return
+            print("notes generated")
+            self.piano_roll.add_notes(generated_to_notes(job.result, self.piano_roll.bpm))
+            self.generation_message = job.status_text()
 
-        midi_data = pretty_midi.PrettyMIDI()
-        instrument = pretty_midi.Instrument(program=0)
-
-        for note_info in self.piano_roll.notes:
-            pitch = note_info.pitch  # Convert note to integer
-            start_time = to_realtime * note_info.start
-            end_time = to_realtime * note_info.end
-            velocity = note_info.velocity
-            note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start_time, end=end_time)
-            instrument.notes.append(note)
-
-        print("notes generated")
-
-        for note_info in response:
-            pitch = int(note_info['note'])  # Convert note to integer
-            start_time = round(note_info['start_time'], 3)
-            end_time = round(start_time + note_info['duration'], 3)
-            velocity = int(note_info['velocity'])  # Convert velocity to integer
-            note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start_time, end=end_time)
-            instrument.notes.append(note)
-        
-        midi_data.instruments.append(instrument)
-        midi_data.write(LAST_GEN_MIDI_FILE_PATH)
+    def add_fallback_notes(self, job, fallback):
+        if self.piano_roll.store.version != job.version:
+            self.fallback = None
+            return
+        self.fallback_notes = generated_to_notes(fallback.result, self.piano_roll.bpm)
+        self.piano_roll.add_notes(self.fallback_notes)
+        self.fallback_version = self.piano_roll.store.version
+        reason = "failed" if job.done() else "is slow"
+        self.generation_message = f"{job.name} {reason}, added the markov_chain continuation instead"
+
+    def draw_status(self):
+        """shows the elapsed time of the running generation, or the result of the last one"""
+        if self.generation is not None and self.fallback_notes is not None:
+            text = f"{self.generation_message} ({self.generation.elapsed():.1f} s)"
+        elif self.generation is not None:
+            text = self.generation.status_text()
+        elif self.fanout is not None:
+            text = self.fanout.status_text()
+        elif self.audio_stream is not None:
+            text = self.audio_stream.status_text()
+        else:
+            text = self.generation_message
+        status_surface = self.status_font.render(text, True, WHITE)
+        status_rect = status_surface.get_rect(midleft=(10, 10))
+        self.image.blit(status_surface, status_rect)
+
+    def tick_to_time(self, tick):
+        return tick / TICKS_IN_BEAT * 60 / self.piano_roll.bpm
+
+    def prepare_gansynth_playback(self, start_tick):
+        """the mp3 covers the whole piano roll, so it is started at the tick's time"""
+        return GANSYNTH_OUTPUT_MP3_PATH, self.tick_to_time(start_tick)
 
-        self.piano_roll.clear_notes()
-        read_midi(LAST_GEN_MIDI_FILE_PATH, self.piano_roll)
+    def prepare_quick_playback(self, start_tick):
+        """notes are rendered in memory from the tick onwards, so they are started at 0. runs on a PrepareJob"""
+        if RENDERER == "builtin":
+            return synth.to_wav(self.render_audio(start_tick)), 0.0
+        return self.piano_roll_to_midi(start_tick), 0.0
 
     def handle_play_click(self):
         """play generated wav from GANSynth"""
-        if self.play_button.text == "Stop":
-            self.generated_music_channel.stop()
-            self.generated_music_playing = False
-            self.music_thread.join()
+        if self.transport.is_playing("wav"):
+            self.transport.stop()
         else:
             if not os.path.exists(GANSYNTH_OUTPUT_MP3_PATH):
                 print('No MP3 to play. Generate with GANSynth first.')
                 return
-            self.music_thread = threading.Thread(target=play_music, args=(GANSYNTH_OUTPUT_MP3_PATH, self.piano_roll, self))
-            self.generated_music_playing = "wav"
-            self.music_thread.start()
+            self.transport.play("wav", self.prepare_gansynth_playback, self.piano_roll.playhead_pos)
 
     def handle_quick_play_click(self):
         """play midi from notes in piano roll"""
-        if self.quick_play_button.text == "Stop":
-            self.generated_music_channel.stop()
-            self.generated_music_playing = False
-            self.music_thread.join()
+        if self.transport.is_playing("mid"):
+            self.transport.stop()
         else:
-            temp_midi_path = os.path.join(TEMP_MUSIC_DIRECTORY, TEMP_MIDI_FILE)
-            self.piano_roll_to_midi(temp_midi_path, self.piano_roll.get_playhead_time())
-            self.music_thread = threading.Thread(target=play_music, args=(temp_midi_path, self.piano_roll, self))
-            self.generated_music_playing = "mid"
-            self.music_thread.start()
+            self.transport.play("mid", self.prepare_quick_playback, self.piano_roll.playhead_pos, background=True)
+
+    def handle_pause_click(self):
+        self.transport.toggle_pause()
+
+    def handle_loop_click(self):
+        self.transport.loop = not self.transport.loop
 
     def handle_gansynth_click(self):
-        if self.generated_music_playing and self.generated_music_channel is not None:
-            self.generated_music_channel.stop()
-            self.generated_music_playing = False
-            self.music_thread.join()
-        try:
-            if self.generated_music_channel:
-                self.generated_music_channel.unload()
-            self.piano_roll_to_midi(GANSYNTH_INPUT_PATH)
-            gansynth(GANSYNTH_INPUT_PATH, self.instrument_second)
-        except requests.exceptions.RequestException as e:
-            print(f"Error connecting to API: {e}")
-            print("Maybe music duration is too low or duration for each instrument is too long, try to extend the music or lower the duration for each instrument")
+        """streams GANSynth audio in the background and plays it as it arrives; clicking again stops it"""
+        if self.audio_stream is not None:
+            self.audio_stream.stop()
+            self.generation_message = self.audio_stream.status_text()
+            self.audio_stream = None
             return
+        self.transport.stop()
+        self.transport.music.unload()   # release the mp3 before GANSynth overwrites it
+        midi_file = self.piano_roll_to_midi(pitch_range=GANSYNTH_PITCH_RANGE)
+        instrument_second = self.instrument_second
+        self.audio_stream = AudioStream(
+            lambda on_block: gansynth(midi_file, instrument_second, on_block), name="GANSynth")
+        self.audio_stream.start()
+
+    def poll_audio_stream(self):
+        stream = self.audio_stream
+        if stream is None:
+            return
+        stream.update()
+        if stream.done() and not stream.playing():
+            self.generation_message = stream.status_text()
+            if stream.error is not None:
+                print("Maybe music duration is too low or duration for each instrument is too long, try to extend the music or lower the duration for each instrument")
+            self.audio_stream = None
 
     def handle_export_wav_click(self):
         self.export("wav")
@@ -469,6 +781,16 @@ class Output():
             self.handle_gansynth_click()
         if self.play_button.handle_mouse(pos, event):
             self.handle_play_click()
+        if self.pause_button.handle_mouse(pos, event):
+            self.handle_pause_click()
+        if self.loop_button.handle_mouse(pos, event):
+            self.handle_loop_click()
+        if self.generate_all_button.handle_mouse(pos, event):
+            self.handle_generate_all_click()
+        if self.preview_candidate_button.handle_mouse(pos, event):
+            self.handle_preview_candidate_click()
+        if self.accept_candidate_button.handle_mouse(pos, event):
+            self.handle_accept_candidate_click()
         if self.export_wav_button.handle_mouse(pos, event):
             self.handle_export_wav_click()
         if self.export_midi_button.handle_mouse(pos, event):
@@ -478,32 +800,40 @@ class Output():
         if self.up_instrument_second.handle_mouse(pos, event):
             self.handle_up_instrument_second_click()
         self.extend_options.handle_mouse(pos, event)
+        self.candidate_options.handle_mouse(pos, event)
         self.duration_slider.handle_mouse(pos, event)
 
     def button_text_update(self):
-        if self.generated_music_channel:
-            if not self.generated_music_channel.get_busy():
-                self.quick_play_button.change_text("Quick Play")
-                self.play_button.change_text("Play")
-            elif self.generated_music_playing == "mid":
-                self.quick_play_button.change_text("Stop")
-                self.play_button.change_text("Play")
-            elif self.generated_music_playing == "wav":
-                self.quick_play_button.change_text("Quick Play")
-                self.play_button.change_text("Stop")
-        else:
-            self.quick_play_button.change_text("Quick Play")
-            self.play_button.change_text("Play")
+        self.generated_button.change_text("Cancel" if self.generation is not None else "Generate")
+        self.gansynth_button.change_text("Stop" if self.audio_stream is not None else "GANSynth")
+        self.quick_play_button.change_text("Stop" if self.transport.is_playing("mid") else "Quick Play")
+        self.play_button.change_text("Stop" if self.transport.is_playing("wav") else "Play")
+        self.pause_button.change_text("Resume" if self.transport.paused else "Pause")
+        self.loop_button.change_text("Loop: On" if self.transport.loop else "Loop: Off")
+        fanout_running = self.fanout is not None and not self.fanout.finished
+        self.generate_all_button.change_text("Stop Waiting" if fanout_running else "Generate All")
+        self.preview_candidate_button.change_text("Stop" if self.transport.is_playing("candidate") else "Preview")
 
         self.show_instrument_second.change_text(str(self.instrument_second))
 
 
     def update(self):
         self.image.fill(DARK_GREY)
+        self.poll_generation()
+        self.poll_fanout()
+        self.poll_audio_stream()
+        self.speculate()
+        self.transport.update()
         self.button_text_update()
         self.image.fill(DARK_GREY)
         self.generated_button.draw_button(self.image)
         self.play_button.draw_button(self.image)
+        self.pause_button.draw_button(self.image)
+        self.loop_button.draw_button(self.image)
+        self.generate_all_button.draw_button(self.image)
+        if self.candidate_options.candidates:
+            self.preview_candidate_button.draw_button(self.image)
+            self.accept_candidate_button.draw_button(self.image)
         self.quick_play_button.draw_button(self.image)
         self.gansynth_button.draw_button(self.image)
         self.export_wav_button.draw_button(self.image)
@@ -515,4 +845,6 @@ class Output():
 
         self.extend_options.draw(self.image)
         self.duration_slider.draw(self.image)
+        self.candidate_options.draw(self.image)
+        self.draw_status()
         SCREEN.blit(self.image, self.rect.topleft)
@@ -1,9 +1,12 @@
-from typing import List
+import threading
+from collections import deque
+from typing import List, Tuple
 
 import numpy as np
 import pygame
 from pygame import Color, Surface
 
+from classes.audition import Audition
 from classes.clicktimer import ClickTimer
 from classes.constants import *
 from classes.ui_elements import Button
@@ -32,6 +35,47 @@ class Note():
         x, y = cell
         return self.pitch == y and self.start <= x <= self.end
     
+class NoteStore():
+    '''
+    Versioned, copy-on-write collection of notes.
+
+    Every change builds a new tuple under a lock and publishes it together with a new version number in a single
+    assignment, so readers on any thread (export, generation, playback) can take a snapshot without locking and keep
+    iterating it while the notes change. Notes in the store are never edited in place: an edit replaces a note by a
+    new Note, so a published snapshot never changes.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Tuple[int, Tuple[Note, ...]] = (0, ())
+
+    def snapshot(self) -> Tuple[Note, ...]:
+        return self._state[1]
+
+    def versioned_snapshot(self) -> Tuple[int, Tuple[Note, ...]]:
+        '''The version number and the notes of the same commit.'''
+        return self._state
+
+    @property
+    def version(self) -> int:
+        return self._state[0]
+
+    def commit(self, add=(), remove=(), clear=False, replace=()):
+        '''
+        Applies one batch of changes and publishes it as a new version. `replace` holds (old, new) pairs of notes,
+        where the new note takes the place of the old one.
+        '''
+        with self._lock:
+            version, notes = self._state
+            if clear:
+                notes = ()
+            if remove:
+                removed = {id(note) for note in remove}
+                notes = tuple(note for note in notes if id(note) not in removed)
+            if replace:
+                replacements = {id(old): new for old, new in replace}
+                notes = tuple(replacements.get(id(note), note) for note in notes)
+            self._state = (version + 1, notes + tuple(add))
+
 class VelocitySlider():
     '''
     A UI element for modifying the velocity of a note.
@@ -82,22 +126,29 @@ class VelocitySlider():
         self.notes.clear()
         self.velocity = -1
     
+    def replace_note(self, old: Note, new: Note):
+        self.notes = [new if note is old else note for note in self.notes]
+
     def release_slider(self):
-        '''Releases the slider and saves the new velocity to the notes.'''
+        '''
+        Releases the slider. Returns whether it was being dragged, in which case the notes should be given the new
+        velocity.
+        '''
+        was_dragging = self.is_dragging
         self.is_dragging = False
         self.velocity = int(self.velocity)
-        for note in self.notes:
-                note.velocity = self.velocity
+        return was_dragging
 
     def handle_event(self, mouse_pos, event):
-        '''Handle mouse events on the velocity slider.'''
+        '''Handle mouse events on the velocity slider. Returns whether a new velocity was saved.'''
         if event.type == pygame.MOUSEBUTTONUP:
-            self.release_slider()
+            return self.release_slider()
         elif event.type == pygame.MOUSEBUTTONDOWN and self.on_slider(mouse_pos):
             self.set_velocity(mouse_pos)
             self.is_dragging = True
         elif event.type == pygame.MOUSEMOTION and self.is_dragging:
             self.set_velocity(mouse_pos)
+        return False
 
 
     def get_velocity(self):
@@ -135,7 +186,10 @@ class PianoRoll():
         self.rect = self.image.get_rect()
         self.rect.topleft = [ROLL_LEFT_BOUND, ROLL_UP_BOUND]
 
-        self.notes = []             # notes in the roll
+        self.store = NoteStore()    # notes in the roll
+        self.posted_notes = deque() # notes added from other threads, committed in update()
+        self.posted_resizes = deque()   # (note, duration) set from other threads, committed in update()
+        self.resized_notes = {}     # posted note -> the note that replaced it when it was resized
         self.selected_note: Note = None
         self.edge_pressed = False
 
@@ -148,11 +202,17 @@ class PianoRoll():
         self.plus_button = Button("+", (ROLL_GRID_START-25, self.cell_height//2))
         self.velocity_slider = VelocitySlider((SCREEN_WIDTH-16, 32))
         self.playhead_pos = 0       # in ticks
+        self.audition = Audition()
 
         self.beats_in_bar = 4
         self.cells_in_beat = 4
         self.bpm = 120
     
+    @property
+    def notes(self):
+        '''Immutable snapshot of the notes, safe to iterate from any thread.'''
+        return self.store.snapshot()
+    
     def get_ticks_in_cell(self):
         return TICKS_IN_BEAT // self.cells_in_beat
     
@@ -188,18 +248,73 @@ class PianoRoll():
         return f'{pitch}{octave}'
 
     def add_note(self, note):
-        self.notes.append(note)
+        self.store.commit(add=(note,))
         self.select_note(note)
         return
     
+    def add_notes(self, notes, clear=False):
+        '''Adds many notes in one commit, replacing the current ones if `clear` is True.'''
+        notes = list(notes)
+        self.store.commit(add=notes, clear=clear)
+        if notes:
+            self.select_note(notes[-1])
+        return
+    
+    def replace_notes(self, old_notes, new_notes):
+        '''Removes `old_notes` and adds `new_notes` in one commit.'''
+        new_notes = list(new_notes)
+        self.store.commit(add=new_notes, remove=old_notes)
+        if new_notes:
+            self.select_note(new_notes[-1])
+        return
+    
+    def post_note(self, note):
+        '''Thread-safe add_note for background threads: the note is committed by the next update().'''
+        self.posted_notes.append(note)
+    
+    def post_resize(self, note, duration):
+        '''Thread-safe resize of a posted note for background threads: applied by the next update().'''
+        self.posted_resizes.append((note, duration))
+    
+    def commit_posted_notes(self):
+        notes = []
+        while self.posted_notes:
+            notes.append(self.posted_notes.popleft())
+        if notes:
+            self.add_notes(notes)
+        while self.posted_resizes:
+            note, duration = self.posted_resizes.popleft()
+            self.resized_notes[note] = self.edit_note(self.resized_notes.get(note, note), duration=duration)
+    
+    def edit_note(self, note, **changes):
+        '''
+        Replaces `note` by a copy with some of its pitch, start, duration and velocity changed, in one commit, and
+        returns the copy (or `note` if nothing changed). The selection follows the note.
+        '''
+        new_note = Note(
+            changes.get("pitch", note.pitch),
+            changes.get("start", note.start),
+            changes.get("duration", note.duration),
+            changes.get("velocity", note.velocity),
+        )
+        if (new_note.pitch, new_note.start, new_note.duration, new_note.velocity) == \
+                (note.pitch, note.start, note.duration, note.velocity):
+            return note
+        self.store.commit(replace=((note, new_note),))
+        if self.selected_note is note:
+            self.selected_note = new_note
+        self.velocity_slider.replace_note(note, new_note)
+        return new_note
+    
     def delete_note(self, note):
-        self.notes.remove(note)
+        self.store.commit(remove=(note,))
         self.selected_note = None
         #print(self.notes)
         return
     
     def clear_notes(self):
-        self.notes = []   
+        self.store.commit(clear=True)
+        self.resized_notes.clear()
         return
     
     def select_note(self, note):
@@ -251,6 +366,7 @@ class PianoRoll():
                 if (note):
                     # click on note
                     self.select_note(note)
+                    self.audition.play(note.pitch, note.velocity)
                     #print("note selected")
                     cells_from_lbound = (cell_x - self.window_x) // self.cell_width + 1
                     edge_x = ROLL_GRID_START + cells_from_lbound * self.cell_width
@@ -263,6 +379,7 @@ class PianoRoll():
                     start = cell_x, 
                 )
                 self.add_note(new_note)
+                self.audition.play(new_note.pitch, new_note.velocity)
         if event.button == 3:   #right click
             if (cell_y <= self.window_y):
                 note_to_delete = self.note_from_cell(cell)
@@ -283,15 +400,14 @@ class PianoRoll():
         move_x, move_y = event.rel
         if self.edge_pressed:
             step = move_x / self.cell_width * self.get_ticks_in_cell()
-            self.selected_note.duration += step
-            self.selected_note.end += step
+            self.edit_note(self.selected_note, duration=self.selected_note.duration + step)
         elif self.selected_note:
             new_start, new_pitch = self.click_to_cell_pos(mouse_pos)
             #print((new_start, new_pitch))
             if self.cell_in_grid((new_start, new_pitch)):
-                self.selected_note.start = new_start
-                self.selected_note.end = new_start + self.selected_note.duration
-                self.selected_note.pitch = new_pitch
+                if new_pitch != self.selected_note.pitch:
+                    self.audition.play(new_pitch, self.selected_note.velocity)
+                self.edit_note(self.selected_note, start=new_start, pitch=new_pitch)
             else:
                 self.deselect_note()
         return
@@ -304,17 +420,22 @@ class PianoRoll():
             if self.edge_pressed:
                 #release edge on selected_note
                 self.edge_pressed = False
-                self.selected_note.duration = round(self.selected_note.duration / self.get_ticks_in_cell()) * self.get_ticks_in_cell()
-                self.selected_note.end = self.selected_note.start + self.selected_note.duration
-                if (self.selected_note.duration <= 0):
+                ticks_in_cell = self.get_ticks_in_cell()
+                duration = round(self.selected_note.duration / ticks_in_cell) * ticks_in_cell
+                if (duration <= 0):
                     self.delete_note(self.selected_note)
+                    return
+                self.edit_note(self.selected_note, duration=duration)
                 #print('edge released')
             else: 
                 #release note
                 x_range, y_range = self.get_window_range()
-                self.selected_note.start = min(max(self.selected_note.start, self.window_x), self.window_x+x_range)
-                self.selected_note.end = self.selected_note.start + self.selected_note.duration
-                self.selected_note.pitch = min(max(self.selected_note.pitch, self.window_y-y_range+1), self.window_y)
+                self.edit_note(
+                    self.selected_note,
+                    start=min(max(self.selected_note.start, self.window_x), self.window_x+x_range),
+                    pitch=min(max(self.selected_note.pitch, self.window_y-y_range+1), self.window_y),
+                )
+            # edits are committed as they happen, so a plain click (e.g. to audition a note) changes nothing
             self.selected_note = None
 
 
@@ -348,9 +469,12 @@ class PianoRoll():
         '''Handle all mouse operations in the piano roll.'''
         mouse_pos = np.array(mouse_pos) - np.array([ROLL_LEFT_BOUND, ROLL_UP_BOUND]) # adjust for screen
         if self.velocity_slider.rect.collidepoint(mouse_pos):
-            self.velocity_slider.handle_event(mouse_pos, event)
+            released = self.velocity_slider.handle_event(mouse_pos, event)
         else:
-            self.velocity_slider.release_slider()
+            released = self.velocity_slider.release_slider()
+        if released:
+            for note in list(self.velocity_slider.notes):
+                self.edit_note(note, velocity=self.velocity_slider.velocity)
         if self.plus_button.handle_mouse(mouse_pos, event):
             self.bpm += 1
         if self.minus_button.handle_mouse(mouse_pos, event):
@@ -475,6 +599,7 @@ class PianoRoll():
 
     def update(self):
         '''Draw all parts of the piano roll on screen.'''
+        self.commit_posted_notes()
         self.image.fill(DARK_GREY)
         self.draw_grid()
         self.draw_notes()
@@ -0,0 +1,252 @@
+import threading
+import time
+import wave
+
+import librosa
+import numpy as np
+import pyaudio
+from scipy import signal
+
+ANALYSIS_SR = 22050         # sample rate of the transcription, same as librosa.load
+
+
+class RingBuffer():
+    '''
+    Single-producer / single-consumer ring buffer of float32 samples.
+
+    The producer only advances `write_pos` and the consumer only advances `read_pos`, each after its copy is done,
+    so the two threads never need a lock. Samples that do not fit are dropped and counted in `overruns`.
+    '''
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.write_pos = 0          # total number of samples written
+        self.read_pos = 0           # total number of samples read
+        self.overruns = 0
+
+    def available(self):
+        return self.write_pos - self.read_pos
+
+    def write(self, samples):
+        free = self.capacity - self.available()
+        if len(samples) > free:
+            self.overruns += len(samples) - free
+            samples = samples[:free]
+        start = self.write_pos % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.write_pos += len(samples)
+
+    def read(self, n):
+        '''Returns the next `n` samples, or None if fewer are available.'''
+        if self.available() < n:
+            return None
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        samples = np.concatenate([self.buffer[start:start + first], self.buffer[:n - first]])
+        self.read_pos += n
+        return samples
+
+
+class RecordingBuffer():
+    '''
+    Preallocated float32 buffer holding a whole recording in memory, doubled in size whenever it is full.
+    '''
+    def __init__(self, sr, seconds=60):
+        self.sr = sr
+        self.buffer = np.zeros(int(sr * seconds), dtype=np.float32)
+        self.length = 0
+
+    def append(self, samples):
+        if self.length + len(samples) > len(self.buffer):
+            new_buffer = np.zeros(max(2 * len(self.buffer), self.length + len(samples)), dtype=np.float32)
+            new_buffer[:self.length] = self.buffer[:self.length]
+            self.buffer = new_buffer
+        self.buffer[self.length:self.length + len(samples)] = samples
+        self.length += len(samples)
+
+    def get_audio(self):
+        '''The recorded samples, without copying them.'''
+        return self.buffer[:self.length]
+
+    def write_wav(self, path):
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(self.sr)
+            wf.writeframes((np.clip(self.get_audio(), -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+class StreamDecimator():
+    '''
+    Low-pass filters and keeps every `factor`-th sample of a stream, carrying the filter state across chunks.
+    '''
+    def __init__(self, factor, n_taps=63):
+        self.factor = factor
+        if factor > 1:
+            self.taps = signal.firwin(n_taps, 1 / factor).astype(np.float32)
+            self.state = np.zeros(n_taps - 1, dtype=np.float32)
+        self.position = 0           # total number of input samples
+
+    def __call__(self, samples):
+        if self.factor == 1:
+            return samples
+        filtered, self.state = signal.lfilter(self.taps, 1, samples, zi=self.state)
+        offset = -self.position % self.factor
+        self.position += len(samples)
+        return filtered[offset::self.factor].astype(np.float32)
+
+
+class MicrophoneSource():
+    '''
+    Captures the default input device in PyAudio callback mode and passes `sr` Hz float32 chunks to a sink.
+
+    The device is opened at a multiple of `sr`, so the only resampling is one streaming decimation.
+    '''
+    def __init__(self, sr=ANALYSIS_SR, device_sr=44100, chunk=1024):
+        assert device_sr % sr == 0, f"{device_sr} is not a multiple of {sr}"
+        self.sr = sr
+        self.device_sr = device_sr
+        self.chunk = chunk
+        self.scratch = np.zeros(chunk, dtype=np.float32)
+        self.stream = None
+
+    def start(self, sink):
+        '''Starts calling `sink(samples)` from the audio thread.'''
+        decimate = StreamDecimator(self.device_sr // self.sr)
+
+        def callback(in_data, frame_count, time_info, status):
+            samples = np.frombuffer(in_data, dtype=np.int16)
+            scratch = self.scratch[:len(samples)]
+            np.multiply(samples, 1 / 32768, out=scratch, casting="unsafe")
+            sink(decimate(scratch))
+            return (None, pyaudio.paContinue)
+
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16,
+                                      channels=1,
+                                      rate=self.device_sr,
+                                      input=True,
+                                      frames_per_buffer=self.chunk,
+                                      stream_callback=callback)
+        self.stream.start_stream()
+
+    def stop(self):
+        if self.stream is None:
+            return
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+        self.stream = None
+
+
+class FileSource():
+    '''
+    Plays back an audio file chunk by chunk in place of the microphone, at real-time pace unless `realtime` is False.
+
+    The file is resampled to `sr` once when loaded. `sink(None)` is called at the end of the file.
+    '''
+    def __init__(self, filename, sr=ANALYSIS_SR, chunk=512, realtime=True):
+        self.filename = filename
+        self.sr = sr
+        self.chunk = chunk
+        self.realtime = realtime
+        self.thread = None
+        self.running = False
+
+    def start(self, sink):
+        y, _ = librosa.load(self.filename, sr=self.sr)
+        self.running = True
+        self.thread = threading.Thread(target=self.play, args=(y, sink))
+        self.thread.start()
+
+    def play(self, y, sink):
+        start_time = time.perf_counter()
+        for pos in range(0, len(y), self.chunk):
+            if not self.running:
+                return
+            if self.realtime:
+                time.sleep(max(0, start_time + pos / self.sr - time.perf_counter()))
+            sink(y[pos:pos + self.chunk])
+        sink(None)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class LiveRecorder():
+    '''
+    Records from `source` and feeds a live StreamTranscriber while recording.
+
+    The source's audio thread only copies chunks into a ring buffer. An analysis thread pushes them to `transcriber`
+    one block of `block_frames` hops at a time and keeps the whole recording in memory, so a note shows up about one
+    look-ahead plus one hop after it is played. If `wav_path` is given, the recording is saved once it is stopped.
+    '''
+    def __init__(self, source, transcriber, wav_path=None, block_frames=1, buffer_seconds=10):
+        assert source.sr == transcriber.sr, "source and transcriber must use the same sample rate"
+        self.source = source
+        self.transcriber = transcriber
+        self.wav_path = wav_path
+        self.block_length = block_frames * transcriber.hop_length
+        self.overlap = transcriber.n_fft - transcriber.hop_length
+        self.ring = RingBuffer(int(buffer_seconds * source.sr))
+        self.recording = RecordingBuffer(source.sr)
+
+        self.data_ready = threading.Event()
+        self.capturing = False
+        self.thread = None
+
+    def start(self):
+        self.capturing = True
+        self.thread = threading.Thread(target=self.analyse)
+        self.thread.start()
+        self.source.start(self.on_audio)
+
+    def on_audio(self, samples):
+        '''Sink of the source, called from its audio thread. None marks the end of the audio.'''
+        if samples is None:
+            self.capturing = False
+        else:
+            self.ring.write(samples)
+        self.data_ready.set()
+
+    def stop(self):
+        '''Stops recording and waits until the remaining audio has been transcribed.'''
+        self.source.stop()
+        self.capturing = False
+        self.data_ready.set()
+        self.join()
+
+    def join(self):
+        '''Waits until the source has ended and its audio has been transcribed.'''
+        self.thread.join()
+        self.source.stop()
+        if self.wav_path is not None:
+            threading.Thread(target=self.recording.write_wav, args=(self.wav_path,)).start()
+
+    def analyse(self):
+        tail = None
+        while True:
+            self.data_ready.clear()
+            # the first block also needs the samples of the overlap
+            n_samples = self.block_length + (self.overlap if tail is None else 0)
+            samples = self.ring.read(n_samples)
+            if samples is None:
+                if not self.capturing and self.ring.available() < n_samples:
+                    remaining = self.ring.read(self.ring.available())
+                    self.recording.append(remaining)
+                    if len(remaining):
+                        # the last, partial block is padded with silence, like librosa.stream does
+                        samples = np.pad(remaining, (0, n_samples - len(remaining)))
+                        self.transcriber.push(samples if tail is None else np.concatenate([tail, samples]))
+                    break
+                self.data_ready.wait(timeout=0.1)
+                continue
+            self.recording.append(samples)
+            block = samples if tail is None else np.concatenate([tail, samples])
+            self.transcriber.push(block)
+            tail = block[len(block) - self.overlap:]
+        self.transcriber.finish()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+# File: synth.py
+
+"""
+A wavetable synthesizer for rendering notes in-process, without a MIDI synth or the musgen server.
+
+Every note is one wavetable voice with an ADSR envelope, rendered with vectorized NumPy operations into preallocated
+scratch buffers and overlap-added into the output.
+
+Example:
+```python
+import synth
+audio = synth.render_notes(
+    pitch=[60, 64, 67],
+    start=[0.0, 0.5, 1.0],
+    end=[2.0, 2.0, 2.0],
+    velocity=[80, 70, 70],
+)
+synth.write_wav(audio, "chord.wav")
+```
+
+Long pieces can be rendered across cores with `render_notes_parallel`, which gives exactly the same samples.
+
+Benchmark against FluidSynth (the musgen /midi2wav endpoint):
+```
+python -m classes.synth demo.mid --server http://localhost:8100
+```
+"""
+
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.io import wavfile
+
+SAMPLE_RATE = 44100
+TABLE_SIZE = 4096
+DEFAULT_HARMONICS = (1.0, 0.5, 0.3, 0.15, 0.08, 0.04)
+DEFAULT_ADSR = (0.005, 0.3, 0.4, 0.25)   # attack (s), decay (s), sustain (level), release (s)
+DEFAULT_GAIN = 0.15
+PARALLEL_MIN_SECONDS = 30   # shorter pieces render faster than a process pool starts
+SEGMENTS_PER_WORKER = 4
+
+
+def midi_to_hz(pitch: np.ndarray) -> np.ndarray:
+    return 440.0 * 2.0 ** ((np.asarray(pitch, dtype=np.float64) - 69) / 12)
+
+
+def make_wavetable(harmonics: Sequence[float] = DEFAULT_HARMONICS, size: int = TABLE_SIZE) -> np.ndarray:
+    """
+    Build one period of an additive waveform.
+
+    Args:
+        harmonics (Sequence[float]): Amplitude of each harmonic, starting from the fundamental
+        size (int): Number of samples in the period
+
+    Returns:
+        np.ndarray: `size + 1` float32 samples normalized to a peak of 1, the last one repeating the first so that
+            interpolation never has to wrap around
+    """
+    phase = np.arange(size + 1) * (2 * np.pi / size)
+    table = np.zeros(size + 1)
+    for k, amplitude in enumerate(harmonics):
+        table += amplitude * np.sin((k + 1) * phase)
+    table /= np.max(np.abs(table))
+    return table.astype(np.float32)
+
+
+def adsr_envelope(n_held: int, n_release: int, sr: int, attack: float, decay: float, sustain: float) -> np.ndarray:
+    """
+    Build the envelope of a note held for `n_held` samples.
+
+    The release starts from whatever level the note reached when it was released, so short notes released during
+    the attack or decay do not click.
+
+    Args:
+        n_held (int): Number of samples between note on and note off
+        n_release (int): Number of samples of the release
+        sr (int): Sample rate
+        attack (float): Attack time in seconds
+        decay (float): Decay time in seconds
+        sustain (float): Sustain level, between 0 and 1
+
+    Returns:
+        np.ndarray: `n_held + n_release` float32 gains
+    """
+    n_attack = max(int(attack * sr), 1)
+    n_decay = max(int(decay * sr), 1)
+    t = np.arange(n_held + n_release)
+    held = np.interp(np.minimum(t, n_held), [0, n_attack, n_attack + n_decay], [0.0, 1.0, sustain])
+    release = np.clip(1 - (t - n_held) / n_release, 0, 1)
+    return (held * release).astype(np.float32)
+
+
+def note_extents(start: np.ndarray, end: np.ndarray, sr: int, release: float) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Convert note times to samples.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, int]: first sample of every note, number of held samples of every note, and
+            number of release samples (the same for all notes)
+    """
+    start_sample = np.round(np.asarray(start, dtype=np.float64) * sr).astype(np.int64)
+    end_sample = np.round(np.asarray(end, dtype=np.float64) * sr).astype(np.int64)
+    n_held = np.maximum(end_sample - start_sample, 1)
+    n_release = max(int(release * sr), 1)
+    return start_sample, n_held, n_release
+
+
+def rendered_length(start: Sequence[float], end: Sequence[float], sr: int = SAMPLE_RATE,
+                    adsr: Tuple[float, float, float, float] = DEFAULT_ADSR) -> int:
+    """Number of samples needed to render the notes, including the release of the last one."""
+    if len(start) == 0:
+        return 0
+    start_sample, n_held, n_release = note_extents(start, end, sr, adsr[3])
+    return int(np.max(start_sample + n_held)) + n_release
+
+
+def render_notes(pitch: Sequence[int], start: Sequence[float], end: Sequence[float], velocity: Sequence[int],
+                 sr: int = SAMPLE_RATE, wavetable: Optional[np.ndarray] = None,
+                 adsr: Tuple[float, float, float, float] = DEFAULT_ADSR, gain: float = DEFAULT_GAIN,
+                 offset: int = 0, length: Optional[int] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Render notes to a mono float32 buffer.
+
+    Only the samples in `[offset, offset + length)` are rendered. Each sample of a note only depends on its position
+    within the note, so rendering a range gives exactly the same samples as the same range of a full render.
+
+    Args:
+        pitch (Sequence[int]): MIDI pitch of every note
+        start (Sequence[float]): Note on time of every note in seconds
+        end (Sequence[float]): Note off time of every note in seconds
+        velocity (Sequence[int]): MIDI velocity of every note
+        sr (int): Sample rate
+        wavetable (np.ndarray): Waveform from `make_wavetable`, a default one is built if None
+        adsr (Tuple[float, float, float, float]): Attack (s), decay (s), sustain (level) and release (s)
+        gain (float): Gain of a note at full velocity
+        offset (int): First sample to render
+        length (int): Number of samples to render, up to the end of the last release if None
+        out (np.ndarray): float32 buffer of `length` samples to add the notes into, a new one is allocated if None
+
+    Returns:
+        np.ndarray: `out`, with the notes added
+    """
+    if wavetable is None:
+        wavetable = make_wavetable()
+    if length is None:
+        length = max(rendered_length(start, end, sr, adsr) - offset, 0)
+    if out is None:
+        out = np.zeros(length, dtype=np.float32)
+    if len(pitch) == 0 or length == 0:
+        return out
+
+    attack, decay, sustain, release = adsr
+    table_size = len(wavetable) - 1
+    start_sample, n_held, n_release = note_extents(start, end, sr, release)
+    step = midi_to_hz(pitch) * table_size / sr
+    amplitude = np.asarray(velocity, dtype=np.float64) / 127 * gain
+
+    # scratch buffers shared by all notes, sized for the longest one
+    max_samples = int(np.max(n_held)) + n_release
+    positions = np.arange(max_samples, dtype=np.float64)
+    phase = np.empty(max_samples, dtype=np.float64)
+    index = np.empty(max_samples, dtype=np.int64)
+    voice = np.empty(max_samples, dtype=np.float32)
+    slope = np.empty(max_samples, dtype=np.float32)
+    envelopes: Dict[int, np.ndarray] = {}   # notes of the same length share an envelope
+
+    for i in range(len(start_sample)):
+        note_start = int(start_sample[i])
+        note_samples = int(n_held[i]) + n_release
+        first = max(note_start, offset)
+        last = min(note_start + note_samples, offset + length)
+        if first >= last:
+            continue
+        lo, hi = first - note_start, last - note_start
+        n = hi - lo
+
+        # linear interpolation in the wavetable at phase p
+        p = phase[:n]
+        np.multiply(positions[lo:hi], step[i], out=p)
+        np.mod(p, table_size, out=p)
+        idx = index[:n]
+        np.copyto(idx, p, casting="unsafe")
+        v = voice[:n]
+        s = slope[:n]
+        np.take(wavetable, idx + 1, out=s)
+        np.take(wavetable, idx, out=v)
+        np.subtract(s, v, out=s)
+        np.subtract(p, idx, out=p)
+        np.multiply(s, p, out=s, casting="unsafe")
+        np.add(v, s, out=v)
+
+        n_key = int(n_held[i])
+        if n_key not in envelopes:
+            envelopes[n_key] = adsr_envelope(n_key, n_release, sr, attack, decay, sustain)
+        np.multiply(v, envelopes[n_key][lo:hi], out=v)
+        np.multiply(v, np.float32(amplitude[i]), out=v)
+        out[first - offset:last - offset] += v
+
+    return out
+
+
+def _render_segment(shm_name: str, total_length: int, offset: int, length: int, pitch, start, end, velocity,
+                    sr, wavetable, adsr, gain):
+    """Worker of `render_notes_parallel`: renders one segment straight into the shared output buffer."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        audio = np.ndarray((total_length,), dtype=np.float32, buffer=shm.buf)
+        render_notes(pitch, start, end, velocity, sr=sr, wavetable=wavetable, adsr=adsr, gain=gain,
+                     offset=offset, length=length, out=audio[offset:offset + length])
+        del audio
+    finally:
+        shm.close()
+
+
+def render_notes_parallel(pitch: Sequence[int], start: Sequence[float], end: Sequence[float],
+                          velocity: Sequence[int], sr: int = SAMPLE_RATE, wavetable: Optional[np.ndarray] = None,
+                          adsr: Tuple[float, float, float, float] = DEFAULT_ADSR, gain: float = DEFAULT_GAIN,
+                          workers: Optional[int] = None) -> np.ndarray:
+    """
+    Render notes like `render_notes`, splitting the timeline into segments rendered by a process pool.
+
+    Every segment is rendered with all the notes that sound in it, including the release tails of notes started in
+    earlier segments, and written into its own range of a shared-memory output buffer. The notes are added in the
+    same order as in a serial render, so the output is bit-identical to `render_notes`.
+
+    Args:
+        pitch, start, end, velocity, sr, wavetable, adsr, gain: See `render_notes`
+        workers (int): Number of processes, `os.cpu_count()` if None
+
+    Returns:
+        np.ndarray: float32 audio
+    """
+    workers = workers or os.cpu_count() or 1
+    total_length = rendered_length(start, end, sr, adsr)
+    if workers == 1 or total_length < PARALLEL_MIN_SECONDS * sr:
+        return render_notes(pitch, start, end, velocity, sr=sr, wavetable=wavetable, adsr=adsr, gain=gain)
+    if wavetable is None:
+        wavetable = make_wavetable()
+
+    pitch, start, end, velocity = (np.asarray(values) for values in (pitch, start, end, velocity))
+    start_sample, n_held, n_release = note_extents(start, end, sr, adsr[3])
+    end_sample = start_sample + n_held + n_release
+    bounds = np.linspace(0, total_length, workers * SEGMENTS_PER_WORKER + 1).astype(np.int64)
+
+    shm = shared_memory.SharedMemory(create=True, size=total_length * np.dtype(np.float32).itemsize)
+    # spawned workers re-import the main module, which opens the app's window; keep theirs headless
+    environ = {key: os.environ.get(key) for key in ("SDL_VIDEODRIVER", "SDL_AUDIODRIVER")}
+    try:
+        audio = np.ndarray((total_length,), dtype=np.float32, buffer=shm.buf)
+        audio[:] = 0
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for offset, segment_end in zip(bounds[:-1], bounds[1:]):
+                sounding = (start_sample < segment_end) & (end_sample > offset)
+                futures.append(executor.submit(
+                    _render_segment, shm.name, total_length, int(offset), int(segment_end - offset),
+                    pitch[sounding], start[sounding], end[sounding], velocity[sounding],
+                    sr, wavetable, adsr, gain,
+                ))
+            for future in futures:
+                future.result()
+        result = audio.copy()
+        del audio
+    finally:
+        for key, value in environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shm.close()
+        shm.unlink()
+    return result
+
+
+def to_pcm16(audio: np.ndarray) -> np.ndarray:
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def write_wav(audio: np.ndarray, file, sr: int = SAMPLE_RATE):
+    """Write float audio as 16-bit PCM to a path or file object."""
+    wavfile.write(file, sr, to_pcm16(audio))
+
+
+def to_wav(audio: np.ndarray, sr: int = SAMPLE_RATE) -> io.BytesIO:
+    """Encode float audio as an in-memory 16-bit WAV file, rewound to the start."""
+    buffer = io.BytesIO()
+    write_wav(audio, buffer, sr)
+    buffer.seek(0)
+    buffer.name = "notes.wav"
+    return buffer
+
+
+def benchmark(midi_path: str, server: Optional[str] = None, repeat: int = 3, workers: Optional[int] = None):
+    """
+    Time the built-in synth, serial and parallel, and optionally FluidSynth behind the musgen /midi2wav endpoint, on
+    a MIDI file.
+    """
+    import pretty_midi
+    import requests
+
+    midi = pretty_midi.PrettyMIDI(midi_path)
+    notes = [note for instrument in midi.instruments if not instrument.is_drum for note in instrument.notes]
+    pitch = [note.pitch for note in notes]
+    start = [note.start for note in notes]
+    end = [note.end for note in notes]
+    velocity = [note.velocity for note in notes]
+    duration = rendered_length(start, end) / SAMPLE_RATE
+    print(f"{midi_path}: {len(notes)} notes, {duration:.1f} s")
+
+    wavetable = make_wavetable()
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        render_notes(pitch, start, end, velocity, wavetable=wavetable)
+        timings.append(time.perf_counter() - begin)
+    best = min(timings)
+    print(f"built-in synth: {best:.3f} s ({duration / best:.0f}x real time)")
+    serial = render_notes(pitch, start, end, velocity, wavetable=wavetable)
+
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        parallel = render_notes_parallel(pitch, start, end, velocity, wavetable=wavetable, workers=workers)
+        timings.append(time.perf_counter() - begin)
+    best = min(timings)
+    identical = np.array_equal(serial, parallel)
+    print(f"built-in synth, parallel: {best:.3f} s ({duration / best:.0f}x real time), identical: {identical}")
+
+    if server is not None:
+        timings = []
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            with open(midi_path, "rb") as midi_file:
+                requests.request(
+                    "POST",
+                    f"{server}/midi2wav",
+                    headers={"Accept": "application/json"},
+                    files={"midi_file": ("input.mid", midi_file, "audio/midi")},
+                ).json()
+            timings.append(time.perf_counter() - begin)
+        best = min(timings)
+        print(f"FluidSynth (/midi2wav): {best:.3f} s ({duration / best:.0f}x real time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the built-in synth against FluidSynth")
+    parser.add_argument("midi_path", type=str, help="MIDI file to render")
+    parser.add_argument(
+        "--server", default=None, type=str,
+        help="musgen server to time /midi2wav on, e.g. http://localhost:8100",
+    )
+    parser.add_argument("--repeat", default=3, type=int, help="Number of renders to keep the fastest of")
+    parser.add_argument("--workers", default=None, type=int, help="Processes for the parallel render")
+    args = parser.parse_args()
+
+    benchmark(args.midi_path, args.server, args.repeat, args.workers)
@@ -0,0 +1,172 @@
+import os
+import time
+
+import pygame
+
+from classes.constants import *
+from classes.jobs import BackgroundJob
+from classes.pianoroll import PianoRoll
+
+
+class PrepareJob(BackgroundJob):
+    '''
+    Calls the `prepare(tick)` of a transport on a worker thread, for sources that take a while to render.
+    '''
+    def __init__(self, prepare, tick):
+        super().__init__("playback")
+        self.prepare = prepare
+        self.tick = tick
+
+    def work(self):
+        return self.prepare(self.tick)
+
+    def report_error(self, e):
+        print(f"Error preparing playback: {e}")
+
+
+class PlaybackTransport():
+    '''
+    Plays MIDI or audio with pygame.mixer.music and moves the playhead from a monotonic clock.
+
+    `update` is called once per frame on the main thread, so the playhead moves at display rate without a polling
+    thread. pygame posts PLAYBACK_END_EVENT when the music ends, which must be passed to `handle_end_event`.
+
+    What is played comes from `prepare(start_tick)`, which returns a path or a named in-memory file object to load and
+    the position (in seconds) to start it from, so that seeking and looping can re-render from any tick. With
+    `background=True`, `prepare` runs on a PrepareJob and playback starts from the next `update` after it finishes,
+    so rendering never blocks a frame; the playhead waits at the start tick meanwhile.
+    '''
+    def __init__(self, piano_roll: PianoRoll):
+        self.piano_roll = piano_roll
+        self.music = pygame.mixer.music
+        self.music.set_endevent(PLAYBACK_END_EVENT)
+
+        self.kind = None            # "mid" or "wav", what was played last
+        self.prepare = None
+        self.background = False     # whether prepare runs on a worker thread
+        self.pending: PrepareJob = None     # source being prepared in the background
+        self.source = None          # kept alive while the mixer streams from it
+        self.playing = False
+        self.paused = False
+        self.loop = False
+        self.loop_tick = 0          # where playback started, and restarts when looping
+
+        self.start_tick = 0
+        self.start_clock = 0
+        self.pause_clock = 0
+        self.ticks_per_second = 0
+        self.last_tick = 0          # last playhead position set by the transport
+
+    def play(self, kind, prepare, start_tick, background=False):
+        self.kind = kind
+        self.prepare = prepare
+        self.background = background
+        self.loop_tick = start_tick
+        self.start(start_tick)
+
+    def start(self, tick):
+        self.cancel_pending()
+        self.start_tick = tick
+        self.last_tick = tick
+        self.playing = True
+        self.paused = False
+        if self.background:
+            self.music.stop()       # rather than keep playing from the old position while rendering
+            self.pending = PrepareJob(self.prepare, tick)
+            self.pending.start()
+        else:
+            self.begin(*self.prepare(tick))
+
+    def begin(self, source, offset):
+        self.source = source
+        try:
+            if isinstance(self.source, str):
+                self.music.load(self.source)
+            else:
+                self.music.load(self.source, os.path.splitext(self.source.name)[1][1:])
+            self.music.play(start=offset)
+        except pygame.error as e:
+            print(e)
+            self.playing = False
+            return
+        self.ticks_per_second = self.piano_roll.bpm * TICKS_IN_BEAT / 60
+        self.start_clock = time.monotonic()
+        if self.paused:             # paused while the source was being prepared
+            self.music.pause()
+            self.pause_clock = self.start_clock
+
+    def cancel_pending(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+    def stop(self):
+        self.cancel_pending()
+        self.playing = False
+        self.paused = False
+        self.music.stop()
+
+    def is_playing(self, kind=None):
+        return self.playing and (kind is None or kind == self.kind)
+
+    def pause(self):
+        if self.playing and not self.paused:
+            if self.pending is None:
+                self.music.pause()
+            self.pause_clock = time.monotonic()
+            self.paused = True
+
+    def resume(self):
+        if self.playing and self.paused:
+            if self.pending is None:
+                self.music.unpause()
+                self.start_clock += time.monotonic() - self.pause_clock
+            self.paused = False
+
+    def toggle_pause(self):
+        if self.paused:
+            self.resume()
+        else:
+            self.pause()
+
+    def seek(self, tick):
+        if not self.playing:
+            return
+        paused = self.paused
+        self.start(tick)
+        if paused:
+            self.pause()
+
+    def current_tick(self):
+        if self.pending is not None:
+            return self.start_tick
+        clock = self.pause_clock if self.paused else time.monotonic()
+        return self.start_tick + (clock - self.start_clock) * self.ticks_per_second
+
+    def update(self):
+        '''Moves the playhead, or seeks if it was moved on the ruler. Called once per frame.'''
+        if not self.playing:
+            return
+        if self.piano_roll.playhead_pos != self.last_tick:
+            self.seek(self.piano_roll.playhead_pos)
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            job = self.pending
+            self.pending = None
+            if job.error is not None:
+                self.playing = False
+                return
+            self.begin(*job.result)
+        tick = int(self.current_tick())
+        self.piano_roll.set_playhead_tick(tick)
+        self.last_tick = self.piano_roll.playhead_pos
+
+    def handle_end_event(self):
+        # stopping or reloading the music also posts the event, so only react if nothing is playing any more
+        if not self.playing or self.paused or self.pending is not None or self.music.get_busy():
+            return
+        if self.loop:
+            self.start(self.loop_tick)
+        else:
+            self.playing = False
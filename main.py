@@ -3,6 +3,7 @@ import sys
 
 import pygame
 
+from classes.api_client import print_latency_report
 from classes.clicktimer import ClickTimer
 from classes.constants import *
 from classes.inputs import Inputs
@@ -10,6 +11,7 @@ from classes.outputs import Output
 from classes.pianoroll import PianoRoll
 
 if __name__ == '__main__':
+    pygame.mixer.pre_init(44100, -16, 2, MIXER_BUFFER)
     pygame.init()
     piano_roll = PianoRoll()
     click_timer = ClickTimer()
@@ -27,8 +29,11 @@ if __name__ == '__main__':
         for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
+                print_latency_report()
                 shutil.rmtree(TEMP_MUSIC_DIRECTORY)  # Remove temporary music directory
                 sys.exit()
+            if event.type == PLAYBACK_END_EVENT:
+                output.transport.handle_end_event()
             if piano_roll.rect.collidepoint(mouse_pos):
                 piano_roll.handle_mouse(mouse_pos, event, click_timer)
             else:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# File: transcribe.py
+
+"""
+Headless batch transcription of a folder of audio files.
+
+Example:
+```bash
+python transcribe.py recordings/ -o transcriptions/ --method librosa --format mid --workers 4
+```
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from pathlib import Path
+
+# classes.constants opens the pygame window on import, so make it a dummy one
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+METHODS = ("librosa", "poly", "mt3")
+
+
+def write_notes(notes, output_path: Path, output_format: str) -> None:
+    """Write the notes and BPM of a NoteCollector as a MIDI file or NumPy note arrays."""
+
+    import numpy as np
+    import pretty_midi
+
+    from classes.constants import TICKS_IN_BEAT
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if output_format == "npz":
+        np.savez_compressed(
+            output_path,
+            bpm=notes.bpm,
+            pitch=np.array([note.pitch for note in notes.notes], dtype=np.int16),
+            start=np.array([note.start for note in notes.notes], dtype=float),
+            duration=np.array([note.duration for note in notes.notes], dtype=float),
+            velocity=np.array([note.velocity for note in notes.notes], dtype=np.int16),
+        )
+    else:
+        to_realtime = 60 / (TICKS_IN_BEAT * notes.bpm)
+        midi_data = pretty_midi.PrettyMIDI(initial_tempo=notes.bpm)
+        instrument = pretty_midi.Instrument(program=0)
+        for note in notes.notes:
+            instrument.notes.append(pretty_midi.Note(
+                velocity=int(note.velocity),
+                pitch=int(note.pitch),
+                start=float(to_realtime * note.start),
+                end=float(to_realtime * note.end),
+            ))
+        midi_data.instruments.append(instrument)
+        midi_data.write(str(output_path))
+
+
+def transcribe_file(audio_path: str, output_path: str, method: str, output_format: str) -> dict:
+    """
+    Transcribe one audio file and write the result. Runs in a worker process.
+
+    Returns:
+        dict: File name, status ("done" or "error"), number of notes, BPM, elapsed seconds and error message
+    """
+
+    from classes.inputs import read_librosa, read_librosa_poly, read_mt3
+    from classes.jobs import NoteCollector
+
+    # a failed request must not write an empty output, which would be skipped as up to date by later runs
+    readers = {"librosa": read_librosa, "poly": read_librosa_poly, "mt3": partial(read_mt3, raise_errors=True)}
+    start = time.perf_counter()
+    try:
+        notes = NoteCollector()
+        readers[method](audio_path, notes)
+        write_notes(notes, Path(output_path), output_format)
+        return {"file": audio_path, "status": "done", "notes": len(notes.notes), "bpm": notes.bpm,
+                "seconds": time.perf_counter() - start, "error": None}
+    except Exception as e:
+        return {"file": audio_path, "status": "error", "notes": 0, "bpm": None,
+                "seconds": time.perf_counter() - start, "error": repr(e)}
+
+
+def find_jobs(input_dir: Path, output_dir: Path, output_format: str, overwrite: bool):
+    """
+    List (audio_path, output_path) pairs under `input_dir`, and the audio files skipped because their output is
+    already newer than them.
+    """
+
+    jobs, skipped = [], []
+    for audio_path in sorted(input_dir.rglob("*")):
+        if audio_path.suffix.lower() not in AUDIO_EXTENSIONS:
+            continue
+        output_path = (output_dir / audio_path.relative_to(input_dir)).with_suffix(f".{output_format}")
+        if not overwrite and output_path.exists() and output_path.stat().st_mtime >= audio_path.stat().st_mtime:
+            skipped.append(str(audio_path))
+        else:
+            jobs.append((str(audio_path), str(output_path)))
+    return jobs, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe every WAV / MP3 file in a folder")
+    parser.add_argument(
+        "input_dir", type=Path,
+        help="Folder searched recursively for audio files",
+    )
+    parser.add_argument(
+        "-o", "--output_dir", default=Path("transcriptions"), type=Path,
+        help="Folder where the transcriptions are written, mirroring the input folder",
+    )
+    parser.add_argument(
+        "-m", "--method", default="librosa", choices=METHODS,
+        help="Transcription method (mt3 requires the mustrans container)",
+    )
+    parser.add_argument(
+        "-f", "--format", default="mid", choices=("mid", "npz"),
+        help="Output format: MIDI file or NumPy note arrays",
+    )
+    parser.add_argument(
+        "-w", "--workers", default=os.cpu_count(), type=int,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true",
+        help="Transcribe files again even if their output is up to date",
+    )
+    parser.add_argument(
+        "--report", default=None, type=Path,
+        help="Also write the summary report to this JSON file",
+    )
+    args = parser.parse_args()
+
+    jobs, skipped = find_jobs(args.input_dir, args.output_dir, args.format, args.overwrite)
+    print(f"{len(jobs)} file(s) to transcribe, {len(skipped)} already done")
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [executor.submit(transcribe_file, audio_path, output_path, args.method, args.format)
+                   for audio_path, output_path in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "done":
+                print(f"[{len(results)}/{len(jobs)}] {result['file']}: {result['notes']} notes, "
+                      f"{result['seconds']:.2f} s")
+            else:
+                print(f"[{len(results)}/{len(jobs)}] {result['file']}: failed ({result['error']})")
+    wall_time = time.perf_counter() - start
+
+    done = [result for result in results if result["status"] == "done"]
+    cpu_time = sum(result["seconds"] for result in results)
+    print("-" * 60)
+    print(f"Transcribed: {len(done)}, failed: {len(results) - len(done)}, skipped: {len(skipped)}")
+    print(f"Wall time: {wall_time:.2f} s, total file time: {cpu_time:.2f} s")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({
+                "method": args.method,
+                "workers": args.workers,
+                "wall_time": wall_time,
+                "results": sorted(results, key=lambda result: result["file"]),
+                "skipped": skipped,
+            }, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()